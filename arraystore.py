@@ -0,0 +1,208 @@
+"""arraystore - XTF channels as directory of .npy arrays, for analysis
+
+Layout of the store directory:
+
+manifest.json - file header, channels, chunk and column file names
+ch<N>/samples_<first ping>.npy - (pings, samples) chunks of CHUNK_PINGS pings
+ch<N>/<field>.npy - sonar packet header fields, one array per field
+
+Chunks are saved from a thread pool while the next ones are collected (at
+most 2 * threads chunks wait for saving), and the directory appears only
+when everything is written. Opening the store doesn't parse anything:
+arrays are memory-mapped.
+
+Usage:
+    export_arrays(infile, 'line1.arrays')
+    store = ArrayStore('line1.arrays')
+    ch = store.channel(0)
+    ch[1000:2000, :512], ch.columns['ping_number']
+"""
+
+import os
+import json
+import shutil
+from tempfile import mkdtemp
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import xtf
+
+CHUNK_PINGS = 4096
+THREADS = 4
+MANIFEST = 'manifest.json'
+
+# numeric sonar packet fields saved as columns
+COLUMN_FIELDS = sorted(name for name, (offset, format)
+                       in xtf.PING_FIELDS.items()
+                       if not format.endswith('s') and
+                          not name.startswith('reserved') and
+                          name != 'magic_number')
+
+def _text(value):
+    return value.rstrip('\0').decode('latin-1') if isinstance(value, str) \
+           else value
+
+class _ChannelWriter(object):
+    def __init__(self, directory, number, chaninfo, chunk_pings, saves):
+        self.directory = directory
+        self.number = number
+        self.chunk_pings = chunk_pings
+        self.saves = saves
+        self.name = 'ch%d' % number
+        os.mkdir(os.path.join(directory, self.name))
+        self.info = dict(type = xtf.CHAN_TYPES.get(chaninfo['type_of_channel'],
+                                                   'unknown'),
+                         dtype = None, n_pings = 0, chunks = [], columns = {})
+        self.pending = []
+        self.columns = dict((name, []) for name in COLUMN_FIELDS)
+
+    def add(self, p):
+        self.pending.append(p)
+        if len(self.pending) >= self.chunk_pings:
+            self.flush()
+
+    def flush(self):
+        packets, self.pending = self.pending, []
+        if not packets:
+            return
+        width = max(len(p.trace) for p in packets)
+        samples = np.zeros((len(packets), width), packets[0].trace.dtype)
+        for row, p in zip(samples, packets):
+            row[:len(p.trace)] = p.trace
+        for name, values in xtf.packet_columns(packets, COLUMN_FIELDS).items():
+            self.columns[name].append(values)
+
+        filename = '%s/samples_%08d.npy' % (self.name, self.info['n_pings'])
+        self.info['chunks'].append(dict(file = filename,
+                                        start = self.info['n_pings'],
+                                        shape = samples.shape))
+        self.info['dtype'] = samples.dtype.str
+        self.info['n_pings'] += len(packets)
+        self.saves.save(os.path.join(self.directory, filename), samples)
+
+    def close(self):
+        self.flush()
+        if not self.info['n_pings']:
+            return self.info
+        for name, parts in self.columns.items():
+            filename = '%s/%s.npy' % (self.name, name)
+            np.save(os.path.join(self.directory, filename),
+                    np.concatenate(parts))
+            self.info['columns'][name] = filename
+        return self.info
+
+class _Saves(object):
+    """np.save() in thread pool, at most `limit` chunks waiting at a time"""
+
+    def __init__(self, pool, limit):
+        self.pool = pool
+        self.limit = limit
+        self.results = []
+
+    def save(self, path, array):
+        while len(self.results) >= self.limit:
+            self.results.pop(0).get() # also raises errors of the save
+        self.results.append(self.pool.apply_async(np.save, (path, array)))
+
+    def wait(self):
+        while self.results:
+            self.results.pop(0).get()
+
+def export_arrays(infile, outdir, channel_numbers = None,
+                  chunk_pings = CHUNK_PINGS, threads = THREADS):
+    """Write channels of XTF file to array store `outdir` (all by default)
+
+    Existing `outdir` is replaced only after successful export.
+    """
+    header, chaninfos, packets = xtf.read_XTF(infile, 'sonar')
+    if channel_numbers is None:
+        channel_numbers = range(len(chaninfos))
+    for ch in channel_numbers:
+        if not 0 <= ch < len(chaninfos):
+            raise xtf.BadDataError('Channel %d not found in "%s"' %
+                                                    (ch + 1, infile))
+
+    parent, name = os.path.split(os.path.abspath(outdir))
+    tmp_dir = mkdtemp(prefix = name + '.', suffix = '.tmp', dir = parent)
+    pool = ThreadPool(threads)
+    saves = _Saves(pool, 2 * threads)
+    try:
+        writers = dict((ch, _ChannelWriter(tmp_dir, ch, chaninfos[ch],
+                                           chunk_pings, saves))
+                       for ch in channel_numbers)
+        for p in packets:
+            writer = writers.get(p.channel_number)
+            if writer is not None:
+                writer.add(p)
+        infos = dict((ch, writer.close()) for ch, writer in writers.items())
+        saves.wait()
+        channels = dict((str(ch), info) for ch, info in infos.items()
+                        if info['n_pings'])
+        manifest = dict(source = os.path.abspath(infile),
+                        chunk_pings = chunk_pings,
+                        header = dict((k, _text(v)) for k, v in header.items()),
+                        channels = channels)
+        with open(os.path.join(tmp_dir, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent = 1, sort_keys = True)
+        pool.close()
+        pool.join()
+        if os.path.exists(outdir):
+            shutil.rmtree(outdir)
+        os.rename(tmp_dir, outdir)
+    except:
+        pool.terminate()
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+        raise
+
+class StoreChannel(object):
+    """Array-like (pings, samples) channel of ArrayStore, memory-mapped
+
+    columns - {field: array} of sonar packet header fields
+    """
+
+    def __init__(self, store, info):
+        self.type = info['type']
+        self.dtype = np.dtype(info['dtype'])
+        self.chunks = [np.load(os.path.join(store.path, c['file']),
+                               mmap_mode = 'r') for c in info['chunks']]
+        self.starts = np.array([c['start'] for c in info['chunks']])
+        self.columns = dict((name, np.load(os.path.join(store.path, f),
+                                           mmap_mode = 'r'))
+                            for name, f in info['columns'].items())
+        self.shape = (info['n_pings'],
+                      max([c.shape[1] for c in self.chunks] or [0]))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        indices, samples, single = xtf.ping_index(key, self.shape[0])
+        out = np.zeros((len(indices), self.shape[1]), self.dtype)
+        chunk_numbers = np.searchsorted(self.starts, indices, 'right') - 1
+        for c in np.unique(chunk_numbers):
+            rows = chunk_numbers == c
+            chunk = self.chunks[c]
+            out[rows, :chunk.shape[1]] = chunk[indices[rows] - self.starts[c]]
+        out = out[:, samples]
+        return out[0] if single else out
+
+class ArrayStore(object):
+    """Array store made by export_arrays"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.header = self.manifest['header']
+
+    def channel_numbers(self):
+        return sorted(int(ch) for ch in self.manifest['channels'])
+
+    def channel(self, number):
+        try:
+            info = self.manifest['channels'][str(number)]
+        except KeyError:
+            raise xtf.BadDataError('Channel %d not found in "%s"' %
+                                                    (number + 1, self.path))
+        return StoreChannel(self, info)
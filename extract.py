@@ -0,0 +1,69 @@
+"""extract - copy time window or ping range of XTF file to XTF or SEG-Y
+
+From command line:
+    python extract.py <xtf-file> <output.xtf | output.seg> <start> <end>
+
+start, end - ping numbers, or times as HH:MM:SS[.ss] (date of the first
+             ping; end before start means next day) or
+             YYYY-MM-DDTHH:MM:SS[.ss]. Both ends are included.
+
+Start and end packets are found by bisection over packet headers, so only
+the window is read from uncompressed files (compressed ones are decompressed
+whole). XTF output is a raw copy of the packets, SEG-Y output has all
+channels.
+"""
+
+import sys
+from datetime import datetime, timedelta
+
+import xtf
+from fileio import open_input, split_ext
+
+TIME_FORMATS = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                '%H:%M:%S.%f', '%H:%M:%S']
+
+def parse_time(s):
+    for format in TIME_FORMATS:
+        try:
+            return datetime.strptime(s, format)
+        except ValueError:
+            pass
+    raise ValueError('Bad time "%s"' % s)
+
+def parse_window(infile, start, end):
+    """find_range arguments from command line start and end"""
+    if ':' not in start + end:
+        return dict(first_ping = int(start), last_ping = int(end))
+    start, end = parse_time(start), parse_time(end)
+    if start.year == 1900: # no date
+        first = xtf.first_ping_time(infile)
+        if first is None:
+            raise xtf.BadDataError('No pings in "%s"' % infile)
+        start += datetime.combine(first.date(), datetime.min.time()) - \
+                 datetime(1900, 1, 1)
+    if end.year == 1900:
+        end += datetime.combine(start.date(), datetime.min.time()) - \
+               datetime(1900, 1, 1)
+        if end < start:
+            end += timedelta(days = 1)
+    return dict(start_time = start, end_time = end)
+
+def main(infile, outfile, start, end):
+    window = parse_window(infile, start, end)
+    if split_ext(outfile)[1].lower() in ('.seg', '.sgy', '.segy'):
+        with open_input(infile) as f:
+            header, chaninfos = xtf.read_header(f.read(xtf.HEADER_LEN))
+        channel_numbers = range(len(chaninfos))
+        xtf.extract_SEGY(infile, outfile, channel_numbers, window = window)
+    else:
+        size = xtf.extract_XTF(infile, outfile, **window)
+        print '%s: %d bytes of packets' % (outfile, size)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 5:
+        sys.exit('Error: wrong arguments\n' + __doc__.rstrip())
+
+    try:
+        main(*sys.argv[1:])
+    except (ValueError, xtf.BadDataError), e:
+        sys.exit('Error: %s' % e)
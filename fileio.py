@@ -0,0 +1,349 @@
+"""fileio - (compressed) input files and background-written output files
+
+Used by xtf.py and segy.py, so that encoding of traces doesn't wait for disk.
+Files are compressed or decompressed transparently, based on suffix:
+
+.gz - gzip
+.xz - xz (needs Python 3 lzma or backports.lzma)
+.zblk - independently zlib-compressed blocks with seek table, fast seek()
+"""
+
+import os
+import sys
+import threading
+import struct
+import zlib
+import gzip
+import mmap
+from Queue import Queue
+from tempfile import mkstemp
+
+CHUNK_SIZE = 4 * 2**20 # small writes are collected into chunks of this size
+QUEUE_SIZE = 8         # maximum number of chunks waiting to be written
+
+BLOCK_SUFFIX = '.zblk'
+BLOCK_SIZE = 2**20 # uncompressed size of .zblk blocks
+BLOCK_MAGIC = 'ZBLK'
+COMPRESSED_SUFFIXES = ('.gz', '.xz', BLOCK_SUFFIX)
+
+def _lzma():
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise ImportError('.xz files need backports.lzma module')
+    return lzma
+
+def split_ext(path):
+    """Like os.path.splitext, but keep compression suffix with extension
+
+    >>> split_ext('line.xtf.gz')
+    ('line', '.xtf.gz')
+    >>> split_ext('line.xtf')
+    ('line', '.xtf')
+    """
+    base, ext = os.path.splitext(path)
+    if ext.lower() in COMPRESSED_SUFFIXES:
+        base, ext2 = os.path.splitext(base)
+        ext = ext2 + ext
+    return base, ext
+
+def open_input(path):
+    """Open file for reading, decompress it depending on suffix"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.gz':
+        return gzip.open(path, 'rb')
+    elif ext == '.xz':
+        return _lzma().LZMAFile(path, 'rb')
+    elif ext == BLOCK_SUFFIX:
+        return BlockReader(path)
+    else:
+        return open(path, 'rb')
+
+def map_input(path):
+    """Whole file as read-only buffer, decompressed if necessary
+
+    Uncompressed files are memory-mapped: only touched pages are read.
+    """
+    if os.path.splitext(path)[1].lower() in COMPRESSED_SUFFIXES:
+        with open_input(path) as f:
+            return f.read()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+def compressor(path):
+    """Compressor object for `path` depending on suffix, or None"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.gz':
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif ext == '.xz':
+        return _lzma().LZMACompressor()
+    elif ext == BLOCK_SUFFIX:
+        return BlockCompressor()
+
+def copy_file(infile, outfile, sync = False):
+    """Copy file, (de)compressing it according to suffixes"""
+    with open_input(infile) as f:
+        with BackgroundWriter(outfile, sync = sync) as out:
+            while True:
+                data = f.read(CHUNK_SIZE)
+                if not data:
+                    break
+                out.write(data)
+
+# .zblk file layout (all numbers are little-endian):
+#
+#   header: magic, block size (4s I)
+#   blocks: zlib-compressed blocks of BLOCK_SIZE bytes (the last may be less)
+#   seek table: file offset of each block (Q)
+#   trailer: uncompressed size, number of blocks, seek table offset, magic
+#            (Q I Q 4s)
+
+BLOCK_HEADER = struct.Struct('<4sI')
+BLOCK_TRAILER = struct.Struct('<QIQ4s')
+
+class BlockCompressor(object):
+    """Compressor producing .zblk data (see zlib.compressobj)"""
+
+    def __init__(self, block_size = BLOCK_SIZE, level = 6):
+        self.block_size = block_size
+        self.level = level
+        self.buffer = bytearray()
+        self.offsets = []
+        self.position = 0
+        self.size = 0
+
+    def _output(self, data):
+        self.position += len(data)
+        return data
+
+    def _block(self, data):
+        self.offsets.append(self.position)
+        self.size += len(data)
+        return self._output(zlib.compress(str(data), self.level))
+
+    def compress(self, data):
+        out = []
+        if self.position == 0:
+            out.append(self._output(BLOCK_HEADER.pack(BLOCK_MAGIC,
+                                                      self.block_size)))
+        self.buffer += data
+        n = len(self.buffer) // self.block_size * self.block_size
+        for i in range(0, n, self.block_size):
+            out.append(self._block(self.buffer[i:i + self.block_size]))
+        del self.buffer[:n]
+        return ''.join(out)
+
+    def flush(self):
+        out = [self.compress('')]
+        if self.buffer:
+            out.append(self._block(self.buffer))
+            self.buffer = bytearray()
+        table_offset = self.position
+        out.append(struct.pack('<%dQ' % len(self.offsets), *self.offsets))
+        out.append(BLOCK_TRAILER.pack(self.size, len(self.offsets),
+                                      table_offset, BLOCK_MAGIC))
+        return ''.join(out)
+
+class BlockReader(object):
+    """Read-only file object for .zblk files, with fast seek()
+
+    Only the blocks actually read are decompressed.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        magic, self.block_size = BLOCK_HEADER.unpack(
+                                        self._file.read(BLOCK_HEADER.size))
+        self._file.seek(-BLOCK_TRAILER.size, os.SEEK_END)
+        self.size, n, table_offset, magic2 = BLOCK_TRAILER.unpack(
+                                        self._file.read(BLOCK_TRAILER.size))
+        if magic != BLOCK_MAGIC or magic2 != BLOCK_MAGIC:
+            raise IOError('Not a %s file: %s' % (BLOCK_SUFFIX, path))
+        self._file.seek(table_offset)
+        self._offsets = struct.unpack('<%dQ' % n, self._file.read(8 * n)) + \
+                        (table_offset,)
+        self._position = 0
+        self._cached = None, ''
+        self.closed = False
+
+    def _load(self, i):
+        if self._cached[0] != i:
+            start, end = self._offsets[i], self._offsets[i + 1]
+            self._file.seek(start)
+            self._cached = i, zlib.decompress(self._file.read(end - start))
+        return self._cached[1]
+
+    def read(self, n = -1):
+        if n < 0:
+            n = self.size - self._position
+        out = []
+        while n > 0 and self._position < self.size:
+            i, start = divmod(self._position, self.block_size)
+            data = self._load(i)[start:start + n]
+            out.append(data)
+            n -= len(data)
+            self._position += len(data)
+        return ''.join(out)
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self._position = max(0, offset)
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        self._file.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+def _umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+class BackgroundWriter(object):
+    """Write-only file object, doing actual writing in a background thread
+
+    Data is written to a temporary file in the same directory as `path`. The
+    temporary file is renamed to `path` only after successful close(), so an
+    existing `path` is never overwritten by a partial file. Errors happening
+    in the writer thread are raised from the next write() or close() call.
+    Data is compressed in the writer thread, if `path` suffix asks for it.
+
+    Use it in `with` statement: on exception the temporary file is removed.
+
+    >>> with BackgroundWriter('/tmp/fileio_doctest') as out:
+    ...     out.write('DATA')
+    >>> open('/tmp/fileio_doctest').read()
+    'DATA'
+    """
+
+    def __init__(self, path, sync = False, chunk_size = CHUNK_SIZE,
+                                           queue_size = QUEUE_SIZE):
+        self.path = path
+        self.sync = sync
+        self.chunk_size = chunk_size
+        self.closed = False
+        self.finished = False
+
+        directory, name = os.path.split(os.path.abspath(path))
+        fd, self.tmp_path = mkstemp(prefix = name + '.', suffix = '.tmp',
+                                    dir = directory)
+        self._file = os.fdopen(fd, 'wb', chunk_size)
+        self._compressor = compressor(path)
+        self._chunk = bytearray()
+        self._queue = Queue(queue_size)
+        self._error = None
+        self._thread = threading.Thread(target = self._run,
+                                        name = 'BackgroundWriter ' + name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            chunk = self._queue.get()
+            if chunk is None:
+                break
+            if self._error is None:
+                try:
+                    if self._compressor is not None:
+                        chunk = self._compressor.compress(str(chunk))
+                    self._file.write(chunk)
+                except Exception:
+                    # keep consuming the queue, so that producer never blocks
+                    self._error = sys.exc_info()
+
+    def _check(self):
+        if self._error is not None:
+            type, value, traceback = self._error
+            raise type, value, traceback
+
+    def write(self, data):
+        self._check()
+        self._chunk += data
+        if len(self._chunk) >= self.chunk_size:
+            self._queue.put(self._chunk)
+            self._chunk = bytearray()
+
+    def _stop(self):
+        if self._chunk:
+            self._queue.put(self._chunk)
+            self._chunk = bytearray()
+        self._queue.put(None)
+        self._thread.join()
+
+    def finish(self):
+        """Write remaining data to the temporary file, don't replace `path`
+
+        Lets several files be completed before any of them is renamed.
+        """
+        if self.finished:
+            return
+        try:
+            self._stop()
+            self._check()
+            if self._compressor is not None:
+                self._file.write(self._compressor.flush())
+            self._file.flush()
+            if self.sync:
+                getattr(os, 'fdatasync', os.fsync)(self._file.fileno())
+            self._file.close()
+            os.chmod(self.tmp_path, 0666 & ~_umask()) # mkstemp makes it 0600
+        except:
+            self.abort()
+            raise
+        self.finished = True
+
+    def close(self):
+        """Write remaining data, then atomically replace `path`"""
+        if self.closed:
+            return
+        self.finish()
+        try:
+            if os.name == 'nt' and os.path.exists(self.path):
+                os.remove(self.path) # rename doesn't replace files on Windows
+            os.rename(self.tmp_path, self.path)
+        except:
+            self.abort()
+            raise
+        self.closed = True
+
+    def abort(self):
+        """Discard written data, leave `path` untouched"""
+        if self.closed:
+            return
+        self.closed = True
+        if self._thread.is_alive():
+            self._chunk = bytearray()
+            self._queue.put(None)
+            self._thread.join()
+        self._file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            self.abort()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
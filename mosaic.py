@@ -0,0 +1,322 @@
+"""mosaic - georeferenced side-scan mosaics of survey lines, for quick look
+
+Port and starboard channel samples are placed across track from sensor
+position (sensor_[xy]coordinate, or ship_* if there's none), perpendicular
+to sensor_heading, after slant-range correction (see processing.SlantRange).
+Positions are projected to UTM, the zone is detected from the first line
+like in xtf.export_SEGY. Samples are accumulated into cells of a raster:
+
+max - the strongest sample, good for targets
+mean - average of samples
+last - the sample of the latest ping
+
+The raster is split into square tiles, made only where there's data. At
+most `max_tiles` tiles are kept in memory, others are moved to a temporary
+directory, so mosaics of any size can be made. Tiles of a ping block are
+accumulated in a thread pool.
+
+Usage:
+    m = Mosaic(resolution = 0.5, method = 'max')
+    for infile in infiles:
+        m.add_line(infile)
+    m.save('mosaic.asc') # ESRI ASCII grid
+    m.close()
+
+From command line:
+    python mosaic.py <mosaic.asc> <cell size, m> <xtf-file> ...
+"""
+
+import os
+import sys
+import shutil
+from tempfile import mkdtemp
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+import xtf
+import processing
+from fileio import BackgroundWriter
+
+RESOLUTION = 1.0 # m
+TILE_SIZE = 512 # cells
+MAX_TILES = 64 # tiles kept in memory
+READ_PINGS = 1024
+THREADS = 4
+NODATA = -9999
+METHODS = ['max', 'mean', 'last']
+
+SIDES = {'port': -1, 'stbd': 1}
+
+FIELDS = ['channel_number', 'num_samples', 'slant_range', 'time_duration',
+          'sensor_primary_altitude', 'sensor_heading', 'sensor_xcoordinate',
+          'sensor_ycoordinate', 'ship_xcoordinate', 'ship_ycoordinate']
+
+def accumulate(tile, cells, values, method):
+    """Add `values` to flat `cells` of tile array, see Mosaic"""
+    n = tile.shape[-1] ** 2
+    if method == 'mean':
+        tile[0] += np.bincount(cells, values, n).reshape(tile.shape[1:])
+        tile[1] += np.bincount(cells, minlength = n).reshape(tile.shape[1:])
+        return
+    if method == 'max':
+        order = np.lexsort((values, cells))
+    else: # the last value of each cell, in order of pings
+        order = np.argsort(cells, kind = 'mergesort')
+    cells, values = cells[order], values[order]
+    last = np.append(cells[1:] != cells[:-1], True)
+    cells, values = cells[last], values[last]
+    flat = tile.ravel()
+    if method == 'max':
+        values = np.fmax(flat[cells], values) # empty cells are NaN
+    flat[cells] = values
+
+class TileStore(object):
+    """Tiles by (column, row) key, the least recently used moved to disk"""
+
+    def __init__(self, shape, dtype, fill, max_tiles = MAX_TILES):
+        self.shape = shape
+        self.dtype = dtype
+        self.fill = fill
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict() # in memory, LRU first
+        self.on_disk = set()
+        self.directory = None
+
+    def path(self, key):
+        return os.path.join(self.directory, 'tile_%d_%d.npy' % key)
+
+    def keys(self):
+        return set(self.tiles) | self.on_disk
+
+    def get(self, key):
+        tile = self.tiles.pop(key, None)
+        if tile is None:
+            if key in self.on_disk:
+                tile = np.load(self.path(key))
+                self.on_disk.remove(key)
+                os.remove(self.path(key))
+            else:
+                tile = np.empty(self.shape, self.dtype)
+                tile.fill(self.fill)
+        self.tiles[key] = tile
+        while len(self.tiles) > self.max_tiles:
+            old_key, old_tile = self.tiles.popitem(last = False)
+            if self.directory is None:
+                self.directory = mkdtemp(prefix = 'mosaic.')
+            np.save(self.path(old_key), old_tile)
+            self.on_disk.add(old_key)
+        return tile
+
+    def close(self):
+        self.tiles.clear()
+        self.on_disk.clear()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors = True)
+            self.directory = None
+
+class Mosaic(object):
+    """Raster of side-scan lines in UTM (see module docstring)
+
+    utm_params - (zone, hemisphere), detected from the first line if None
+    converter - (lon, lat) -> (x, y) function, instead of UTM
+    slant_correction - place samples at ground range, not slant range
+    """
+
+    def __init__(self, resolution = RESOLUTION, method = 'max',
+                       utm_params = None, converter = None,
+                       slant_correction = True, tile_size = TILE_SIZE,
+                       max_tiles = MAX_TILES, threads = THREADS):
+        if method not in METHODS:
+            raise ValueError('Unknown mosaic method "%s"' % method)
+        self.resolution = float(resolution)
+        self.method = method
+        self.utm_params = utm_params
+        self.converter = converter
+        self.slant_correction = slant_correction
+        self.tile_size = tile_size
+        if method == 'mean':
+            shape, dtype, fill = (2, tile_size, tile_size), np.float64, 0
+        else:
+            shape, dtype, fill = (tile_size, tile_size), np.float32, np.nan
+        self.store = TileStore(shape, dtype, fill, max_tiles)
+        self.pool = ThreadPool(threads)
+
+    def _converter(self, lon, lat):
+        if self.converter is None:
+            if self.utm_params is None:
+                self.utm_params = xtf.detect_utm_zone(lon, lat)
+                sys.stdout.write('Detected UTM zone: %d%s\n' % self.utm_params)
+            self.converter = xtf.utm_converter(*self.utm_params)
+        return self.converter
+
+    def add_line(self, infile, channel_numbers = None):
+        """Add port and starboard channels of XTF file, return ping count"""
+        columns = xtf.read_ping_columns(infile, FIELDS)
+        n_pings = 0
+        with xtf.open_reader(infile) as reader:
+            for number, info in enumerate(reader.chaninfos):
+                side = SIDES.get(xtf.CHAN_TYPES.get(info['type_of_channel']))
+                if side is None or (channel_numbers is not None and
+                                    number not in channel_numbers):
+                    continue
+                mine = columns['channel_number'] == number
+                mine_columns = dict((name, values[mine])
+                                    for name, values in columns.items())
+                channel = reader.channel(number)
+                slant = processing.SlantRange() if self.slant_correction \
+                        else None
+                for start in range(0, len(channel), READ_PINGS):
+                    block = channel[start:start + READ_PINGS]
+                    self.add_pings(np.abs(block.astype(np.float32)),
+                                   dict((name, values[start:start + READ_PINGS])
+                                        for name, values in
+                                        mine_columns.items()),
+                                   side, slant)
+                n_pings += len(channel)
+        return n_pings
+
+    def add_pings(self, block, columns, side, slant = None):
+        """Add (pings, samples) block of one channel
+
+        columns - FIELDS of the pings, side - -1 for port, 1 for starboard
+        slant - SlantRange operator, or None for no correction
+        """
+        lon = columns['sensor_xcoordinate']
+        lat = columns['sensor_ycoordinate']
+        no_sensor = (lon == 0) & (lat == 0)
+        lon = np.where(no_sensor, columns['ship_xcoordinate'], lon)
+        lat = np.where(no_sensor, columns['ship_ycoordinate'], lat)
+        fix = (lon != 0) | (lat != 0)
+        if not fix.any():
+            return
+
+        dr = processing.range_spacing(columns)
+        max_range = dr * columns['num_samples']
+        if slant is not None:
+            block = slant(block, columns)
+            altitude = columns['sensor_primary_altitude']
+            max_range = np.sqrt(np.maximum(max_range ** 2 - altitude ** 2, 0))
+
+        # samples much closer than a cell are thinned out
+        step = max(1, int(self.resolution / dr[fix].max() / 2))
+        block = block[fix, ::step]
+        distance = (dr[fix, np.newaxis] * step *
+                    np.arange(block.shape[1]) * side)
+        inside = np.abs(distance) < max_range[fix, np.newaxis]
+
+        x0, y0 = self._converter(lon[fix][0], lat[fix][0])(lon[fix], lat[fix])
+        heading = np.radians(columns['sensor_heading'][fix])
+        # starboard is heading + 90 degrees: (east, north) = (cos, -sin)
+        x = np.asarray(x0)[:, np.newaxis] + distance * np.cos(heading)[:,
+                                                                 np.newaxis]
+        y = np.asarray(y0)[:, np.newaxis] - distance * np.sin(heading)[:,
+                                                                 np.newaxis]
+        self.add_points(x[inside], y[inside], block[inside])
+
+    def add_points(self, x, y, values):
+        """Accumulate values at projected points into tiles"""
+        column = np.floor(x / self.resolution).astype(np.int64)
+        row = np.floor(y / self.resolution).astype(np.int64)
+        tx, ty = column // self.tile_size, row // self.tile_size
+        order = np.lexsort((ty, tx))
+        tx, ty = tx[order], ty[order]
+        cells = ((row[order] - ty * self.tile_size) * self.tile_size +
+                 column[order] - tx * self.tile_size)
+        values = values[order].astype(np.float64)
+        starts = np.flatnonzero(np.append(True, (tx[1:] != tx[:-1]) |
+                                                (ty[1:] != ty[:-1])))
+        ends = np.append(starts[1:], len(cells))
+
+        groups = zip(starts, ends)
+        for i in range(0, len(groups), self.store.max_tiles):
+            tasks = [(self.store.get((int(tx[start]), int(ty[start]))),
+                      cells[start:end], values[start:end], self.method)
+                     for start, end in groups[i:i + self.store.max_tiles]]
+            self.pool.map(lambda args: accumulate(*args), tasks)
+
+    def tile_values(self, tile):
+        """Cell values of tile, NaN where empty"""
+        if self.method != 'mean':
+            return tile
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            return (tile[0] / tile[1]).astype(np.float32)
+
+    def bounds(self):
+        """(first tile column, first tile row, columns, rows) or None"""
+        keys = self.store.keys()
+        if not keys:
+            return None
+        tx = [k[0] for k in keys]
+        ty = [k[1] for k in keys]
+        return (min(tx), min(ty), max(tx) - min(tx) + 1,
+                max(ty) - min(ty) + 1)
+
+    def tile_rows(self):
+        """Yield (rows array, lower left x, lower left y) strips of tiles
+        from north to south, rows array has north row first
+        """
+        bounds = self.bounds()
+        if bounds is None:
+            return
+        tx0, ty0, n_tx, n_ty = bounds
+        t = self.tile_size
+        keys = self.store.keys()
+        for ty in range(ty0 + n_ty - 1, ty0 - 1, -1):
+            strip = np.empty((t, n_tx * t), np.float32)
+            strip.fill(np.nan)
+            for tx in range(tx0, tx0 + n_tx):
+                if (tx, ty) in keys:
+                    strip[:, (tx - tx0) * t:(tx - tx0 + 1) * t] = \
+                            self.tile_values(self.store.get((tx, ty)))
+            yield (strip[::-1], tx0 * t * self.resolution,
+                                ty * t * self.resolution)
+
+    def array(self):
+        """(raster, (lower left x, lower left y)), raster has north row first
+        and NaN in empty cells. Whole mosaic is in memory, see save()
+        """
+        strips = list(self.tile_rows())
+        if not strips:
+            return np.zeros((0, 0), np.float32), (0.0, 0.0)
+        return np.vstack([s[0] for s in strips]), strips[-1][1:]
+
+    def save(self, outfile, sync = False):
+        """Write ESRI ASCII grid, one strip of tiles in memory at a time"""
+        bounds = self.bounds()
+        if bounds is None:
+            raise ValueError('Empty mosaic')
+        tx0, ty0, n_tx, n_ty = bounds
+        t = self.tile_size
+        with BackgroundWriter(outfile, sync = sync) as out:
+            out.write('ncols %d\nnrows %d\nxllcorner %.3f\nyllcorner %.3f\n'
+                      'cellsize %g\nNODATA_value %d\n' %
+                      (n_tx * t, n_ty * t, tx0 * t * self.resolution,
+                       ty0 * t * self.resolution, self.resolution, NODATA))
+            for strip, x, y in self.tile_rows():
+                strip[np.isnan(strip)] = NODATA
+                for row in strip:
+                    out.write(' '.join('%g' % v for v in row) + '\n')
+
+    def close(self):
+        self.pool.terminate()
+        self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+def main(outfile, resolution, infiles):
+    with Mosaic(float(resolution)) as m:
+        for infile in infiles:
+            print '%s: %d pings' % (infile, m.add_line(infile))
+        m.save(outfile)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        sys.exit('Error: wrong arguments\n' + __doc__.rstrip())
+
+    main(sys.argv[1], sys.argv[2], sys.argv[3:])
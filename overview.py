@@ -0,0 +1,188 @@
+"""overview - decimated thumbnails of survey lines, for whole-project view
+
+Thumbnail of a channel is made of |samples|, reduced (max or mean) over
+blocks of PING_STEP pings and over enough samples to get at most HEIGHT
+rows. Only the pings are read, see xtf.open_reader(). Files are processed in a
+process pool, and thumbnails are cached next to project file (see
+cache_path), so only new or changed files are read again.
+
+Usage:
+    cache = OverviewCache.load(cache_path(project_file))
+    cache.update(filenames, project_dir)
+    cache.save()
+    strip, spans = cache.strip(filenames, channel = 0)
+"""
+
+import os
+import json
+from multiprocessing import Pool
+
+import numpy as np
+
+import xtf
+
+PING_STEP = 32 # pings per thumbnail column
+HEIGHT = 128 # maximum thumbnail rows
+READ_PINGS = 4096 # pings read at once
+GAP = 4 # columns between lines in overview strip
+
+def cache_path(project_file):
+    return os.path.splitext(project_file)[0] + '.overview.npz'
+
+def reduce_blocks(a, step, axis, method):
+    """Reduce groups of `step` elements along `axis` with max or mean"""
+    starts = np.arange(0, a.shape[axis], step)
+    if method == 'max':
+        return np.maximum.reduceat(a, starts, axis = axis)
+    counts = np.diff(np.append(starts, a.shape[axis]))
+    shape = [1, 1]
+    shape[axis] = len(counts)
+    return np.add.reduceat(a, starts, axis = axis) / counts.reshape(shape)
+
+def thumbnails(infile, ping_step = PING_STEP, height = HEIGHT,
+                       method = 'max'):
+    """{channel number: thumbnail} of XTF file, thumbnails are
+    (samples, pings) float32 arrays like xtf.grayscale_arrays_gen data
+    """
+    result = {}
+    with xtf.open_reader(infile) as reader:
+        for number in range(len(reader.chaninfos)):
+            channel = reader.channel(number)
+            n_pings, n_samples = channel.shape
+            if n_pings == 0:
+                continue
+            sample_step = -(-n_samples // height)
+            read = READ_PINGS // ping_step * ping_step
+            columns = []
+            for start in range(0, n_pings, read):
+                block = np.abs(channel[start:start + read].astype(np.float32))
+                block = reduce_blocks(block, ping_step, 0, method)
+                columns.append(reduce_blocks(block, sample_step, 1, method))
+            result[number] = np.vstack(columns).T.astype(np.float32)
+    return result
+
+def _thumbnails((path, ping_step, height, method)):
+    """Pool worker: (thumbnails, None) or (None, error message)"""
+    try:
+        return thumbnails(path, ping_step, height, method), None
+    except Exception, e: # any error only leaves this file out
+        return None, '%s: %s' % (type(e).__name__, e)
+
+class OverviewCache(object):
+    """Thumbnails of survey lines (see module docstring)"""
+
+    def __init__(self, path = None, ping_step = PING_STEP, height = HEIGHT,
+                                    method = 'max'):
+        self.path = path
+        self.ping_step = ping_step
+        self.height = height
+        self.method = method
+        self.lines = {} # filename -> dict(mtime, size, channels)
+        self.errors = {} # filename -> error message of the last update
+
+    @classmethod
+    def load(cls, path, **kw):
+        """Load cache from `path`, or return empty one if there's none"""
+        cache = cls(path, **kw)
+        if os.path.exists(path):
+            data = np.load(path)
+            meta = json.loads(str(data['meta']))
+            if ([meta['ping_step'], meta['height'], meta['method']] ==
+                    [cache.ping_step, cache.height, cache.method]):
+                for name, line in meta['lines'].items():
+                    channels = dict((int(number), data[key])
+                                    for number, key in line['channels'])
+                    cache.lines[name] = dict(mtime = line['mtime'],
+                                             size = line['size'],
+                                             channels = channels)
+            data.close()
+        return cache
+
+    def save(self, path = None):
+        self.path = path or self.path
+        arrays = {}
+        lines = {}
+        for name, line in self.lines.items():
+            keys = []
+            for number, a in sorted(line['channels'].items()):
+                key = 'a%d' % len(arrays)
+                arrays[key] = a
+                keys.append((number, key))
+            lines[name] = dict(mtime = line['mtime'], size = line['size'],
+                               channels = keys)
+        meta = dict(ping_step = self.ping_step, height = self.height,
+                    method = self.method, lines = lines)
+        with open(self.path, 'wb') as f:
+            np.savez_compressed(f, meta = np.array(json.dumps(meta)),
+                                **arrays)
+
+    def remove(self, name):
+        self.lines.pop(name, None)
+
+    def update(self, filenames, base_dir = '', processes = None):
+        """Make thumbnails of new or changed files in a process pool
+
+        Return number of files (re)read. Files with errors are left out,
+        see `errors`.
+        """
+        changed = []
+        for name in filenames:
+            try:
+                st = os.stat(os.path.join(base_dir, name))
+            except EnvironmentError, e: # e.g. removed from disk
+                self.errors[name] = '%s: %s' % (type(e).__name__, e)
+                self.remove(name)
+                continue
+            line = self.lines.get(name)
+            if not line or (line['mtime'], line['size']) != (st.st_mtime,
+                                                             st.st_size):
+                changed.append((name, st))
+        if not changed:
+            return 0
+
+        tasks = [(os.path.join(base_dir, name), self.ping_step, self.height,
+                  self.method) for name, st in changed]
+        if len(tasks) == 1:
+            results = [_thumbnails(tasks[0])]
+        else:
+            pool = Pool(processes)
+            try:
+                results = pool.map(_thumbnails, tasks)
+            finally:
+                pool.terminate()
+
+        for (name, st), (channels, error) in zip(changed, results):
+            if error is None:
+                self.errors.pop(name, None)
+                self.lines[name] = dict(mtime = st.st_mtime, size = st.st_size,
+                                        channels = channels)
+            else:
+                self.errors[name] = error
+                self.remove(name)
+        return len(changed)
+
+    def strip(self, filenames, channel, gap = GAP):
+        """Thumbnails of `channel` side by side: (strip array, spans)
+
+        spans - (filename, first column, end column) of every line
+        """
+        parts, spans = [], []
+        column = 0
+        for name in filenames:
+            line = self.lines.get(name)
+            if line is None or channel not in line['channels']:
+                continue
+            a = line['channels'][channel]
+            part = np.zeros((self.height, a.shape[1] + gap), np.float32)
+            part[:a.shape[0], :a.shape[1]] = a
+            parts.append(part)
+            spans.append((name, column, column + a.shape[1]))
+            column += part.shape[1]
+        if not parts:
+            return np.zeros((self.height, 0), np.float32), spans
+        return np.hstack(parts), spans
+
+    def channels(self):
+        """Sorted channel numbers present in any line"""
+        return sorted(set(number for line in self.lines.values()
+                                 for number in line['channels']))
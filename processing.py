@@ -0,0 +1,228 @@
+"""processing - signal processing of sonar traces, block by block
+
+Operators are callables op(block, columns) -> block:
+
+block - (pings, samples) float array
+columns - dict of ping columns for the same pings, see xtf.PROCESS_FIELDS
+          (time_delay, time_duration and num_samples are in seconds/samples,
+          time is ping time in seconds since 1970)
+
+Lines are processed in blocks of pings (see xtf.BLOCK_PINGS), so the whole
+line never has to be in memory. Operators working across pings (PingMix)
+keep state between blocks, so results don't depend on block boundaries.
+Each channel needs its own operator: xtf functions taking `process` option
+make a copy of it for every channel.
+
+Usage:
+    process = Pipeline(TimeGain(power = 2), Bandpass(2000, 8000), Envelope())
+    xtf.export_SEGY(infile, outfile, [0], process = process,
+                                          sample_format = 'f')
+    xtf.export_SEGY(infile, 'port.seg', [0], process = SlantRange())
+"""
+
+import numpy as np
+
+def sample_interval(columns):
+    """Sample interval (s) of the first ping in block"""
+    return float(columns['time_duration'][0]) / columns['num_samples'][0]
+
+def sample_times(block, columns):
+    """Two-way travel time (s) of every sample in block"""
+    dt = columns['time_duration'] / columns['num_samples']
+    return (columns['time_delay'][:, np.newaxis] +
+            dt[:, np.newaxis] * np.arange(block.shape[1]))
+
+def range_spacing(columns, sound_velocity = 1500.0):
+    """Slant range (m) between samples of every ping: slant_range /
+    num_samples, or from time and `sound_velocity` where slant_range is 0
+    """
+    num_samples = np.asarray(columns['num_samples'], np.float64)
+    dr = np.asarray(columns['slant_range'], np.float64) / num_samples
+    if (dr <= 0).any():
+        dr_time = sound_velocity / 2 * columns['time_duration'] / num_samples
+        dr = np.where(dr > 0, dr, dr_time)
+    return dr
+
+class Pipeline(object):
+    """Apply operators one after another"""
+
+    def __init__(self, *ops):
+        self.ops = ops
+
+    def __call__(self, block, columns):
+        for op in self.ops:
+            block = op(block, columns)
+        return block
+
+class TimeGain(object):
+    """Time-varying gain: t**power * 10**(db_per_second * t / 20)"""
+
+    def __init__(self, power = 1.0, db_per_second = 0.0):
+        self.power = power
+        self.db_per_second = db_per_second
+
+    def __call__(self, block, columns):
+        t = sample_times(block, columns)
+        gain = t ** self.power * 10 ** (self.db_per_second * t / 20.0)
+        return (block * gain).astype(np.float32)
+
+class AGC(object):
+    """Automatic gain control: divide by mean amplitude in `window` seconds"""
+
+    def __init__(self, window = 0.005):
+        self.window = window
+
+    def __call__(self, block, columns):
+        n = max(1, int(round(self.window / sample_interval(columns))))
+        # moving sum of |samples| in centered window, via cumulative sums
+        c = np.cumsum(np.abs(block), axis = 1, dtype = np.float64)
+        c = np.hstack([np.zeros((len(block), 1)), c])
+        lo = np.clip(np.arange(block.shape[1]) - n // 2, 0, block.shape[1])
+        hi = np.clip(lo + n, 0, block.shape[1])
+        mean = (c[:, hi] - c[:, lo]) / (hi - lo)
+        return (block / np.maximum(mean, 1e-12)).astype(np.float32)
+
+class Bandpass(object):
+    """Zero-phase FFT band-pass filter from `low` to `high` Hz"""
+
+    def __init__(self, low = None, high = None):
+        self.low = low
+        self.high = high
+
+    def __call__(self, block, columns):
+        n = block.shape[1]
+        spectrum = np.fft.rfft(block, axis = 1)
+        # np.fft.rfftfreq() needs numpy 1.8
+        f = np.arange(n // 2 + 1) / (n * sample_interval(columns))
+        keep = np.ones(len(f), dtype = bool)
+        if self.low is not None:
+            keep &= f >= self.low
+        if self.high is not None:
+            keep &= f <= self.high
+        spectrum[:, ~keep] = 0
+        return np.fft.irfft(spectrum, n, axis = 1).astype(np.float32)
+
+class Envelope(object):
+    """Instantaneous amplitude (magnitude of analytic signal)"""
+
+    def __call__(self, block, columns):
+        n = block.shape[1]
+        spectrum = np.fft.fft(block, axis = 1)
+        h = np.zeros(n)
+        h[0] = 1
+        h[1:(n + 1) // 2] = 2
+        if n % 2 == 0:
+            h[n // 2] = 1
+        return np.abs(np.fft.ifft(spectrum * h, axis = 1)).astype(np.float32)
+
+class PingMix(object):
+    """Running mean of the last `n` pings, continued across blocks
+
+    >>> a = np.arange(8.0).reshape(4, 2)
+    >>> mix = PingMix(2)
+    >>> np.vstack([mix(a[:1], {}), mix(a[1:], {})]).tolist()
+    [[0.0, 1.0], [1.0, 2.0], [3.0, 4.0], [5.0, 6.0]]
+    """
+
+    def __init__(self, n = 3):
+        self.n = n
+        self.previous = None # last n - 1 input pings
+
+    def __call__(self, block, columns):
+        if self.previous is None:
+            self.previous = np.zeros((0, block.shape[1]), block.dtype)
+        data = np.vstack([self.previous, block])
+        c = np.vstack([np.zeros((1, data.shape[1])),
+                       np.cumsum(data, axis = 0, dtype = np.float64)])
+        hi = np.arange(len(self.previous), len(data)) + 1
+        lo = np.maximum(hi - self.n, 0)
+        out = (c[hi] - c[lo]) / (hi - lo)[:, np.newaxis]
+        self.previous = data[max(len(data) - (self.n - 1), 0):] \
+                        if self.n > 1 else data[:0]
+        return out.astype(np.float32)
+
+class SlantRange(object):
+    """Side-scan slant-range to ground-range correction
+
+    Output sample j is at horizontal distance j * dr from nadir, where dr is
+    slant range sample spacing (slant_range / num_samples, or from time and
+    `sound_velocity` if slant_range is zero). Samples beyond the recorded
+    range are zeros, water column is dropped. Pings without altitude are
+    left as they are.
+
+    In units of dr, source index depends only on altitude in samples, so
+    index maps are computed once per (altitude, trace length) and cached.
+    Only for side-scan channels.
+
+    >>> block = np.arange(6.0).reshape(1, 6)
+    >>> columns = dict(slant_range = np.array([6.0]), num_samples = [6],
+    ...                sensor_primary_altitude = np.array([3.0]))
+    >>> SlantRange()(block, columns).tolist()
+    [[3.0, 3.0, 4.0, 4.0, 5.0, 0.0]]
+    """
+
+    def __init__(self, sound_velocity = 1500.0):
+        self.sound_velocity = sound_velocity
+        self.maps = {} # (altitude in samples, samples) -> source indices
+
+    def index_map(self, altitude, n):
+        """Source sample of every output sample, n where outside trace"""
+        key = altitude, n
+        if key not in self.maps:
+            j = np.arange(n)
+            index = np.round(np.hypot(j, altitude)).astype(np.intp)
+            self.maps[key] = np.where(index < n, index, n)
+        return self.maps[key]
+
+    def __call__(self, block, columns):
+        n = block.shape[1]
+        dr = range_spacing(columns, self.sound_velocity)
+        altitude = np.round(columns['sensor_primary_altitude'] / dr)
+        altitude = np.where(altitude > 0, altitude, 0).astype(int)
+
+        altitudes, which = np.unique(altitude, return_inverse = True)
+        index = np.vstack([self.index_map(a, n) for a in altitudes])[which]
+        padded = np.hstack([block, np.zeros((len(block), 1), block.dtype)])
+        return padded[np.arange(len(block))[:, np.newaxis],
+                      index].astype(np.float32)
+
+class Heave(object):
+    """Heave correction of subbottom traces: shift by two-way time of heave
+
+    attitude - xtf.AttitudeSeries, interpolated to ping times (filled in
+               the same pass, see `attitude` option of xtf.export_SEGY);
+               None to use heave of sonar packet headers
+    Positive heave is up: traces are shifted to later times by
+    2 * heave / sound_velocity. Samples shifted in are zeros.
+
+    >>> block = np.arange(1.0, 5.0).reshape(1, 4)
+    >>> columns = dict(heave = np.array([0.75]), time_duration = [0.004],
+    ...                num_samples = [4])
+    >>> Heave()(block, columns).tolist()
+    [[0.0, 1.0, 2.0, 3.0]]
+    """
+
+    def __init__(self, attitude = None, sound_velocity = 1500.0):
+        self.attitude = attitude
+        self.sound_velocity = sound_velocity
+
+    def __call__(self, block, columns):
+        if self.attitude is not None:
+            heave = self.attitude.interpolate(columns['time'],
+                                              ['heave'])['heave']
+        else:
+            heave = np.asarray(columns['heave'], np.float64)
+        dt = (np.asarray(columns['time_duration'], np.float64) /
+              columns['num_samples'])
+        shift = np.round(2 * heave / self.sound_velocity / dt).astype(int)
+        n = block.shape[1]
+        index = np.arange(n) - shift[:, np.newaxis]
+        inside = (index >= 0) & (index < n)
+        out = np.zeros(block.shape, np.float32)
+        rows = np.nonzero(inside)[0]
+        out[inside] = block[rows, index[inside]]
+        return out
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,157 @@
+"""qc - quality control of XTF lines before export
+
+Checks are made on header columns (see xtf.read_ping_columns), with numpy:
+
+ping_gaps - ping numbers missing in a channel: [ping before gap, missing]
+duplicate_pings - ping numbers repeated (or going back) in a channel
+num_samples_changes, time_duration_changes - [ping, new value]
+time_jumps - ping time going back or jumping: [ping, seconds]
+nav_spikes - implied ship speed over max_speed: [ping, m/s]
+amplitude - sample statistics of each channel
+
+Each list is cut to MAX_ITEMS entries, full count is in *_count.
+
+From command line:
+    python qc.py <report.json> <xtf-file> ...
+"""
+
+import sys
+import json
+from multiprocessing import Pool
+
+import numpy as np
+
+import xtf
+from fileio import BackgroundWriter
+
+MAX_ITEMS = 100
+MAX_SPEED = 10.0 # m/s, ~20 knots
+TIME_JUMP = 10 # times median ping interval
+READ_PINGS = 4096
+
+FIELDS = xtf.TIME_FIELDS + ['ping_number', 'channel_number', 'num_samples',
+                            'time_duration', 'ship_xcoordinate',
+                            'ship_ycoordinate']
+
+def _items(report, name, pings, values):
+    report[name + '_count'] = len(pings)
+    report[name] = [[int(p), v.item()] for p, v in zip(pings[:MAX_ITEMS],
+                                                      values[:MAX_ITEMS])]
+
+def channel_checks(columns):
+    """Ping number and record length checks of one channel's columns"""
+    report = dict(pings = len(columns['ping_number']))
+    pings = columns['ping_number'].astype(np.int64)
+    d = np.diff(pings)
+    gaps = d > 1
+    _items(report, 'ping_gaps', pings[:-1][gaps], d[gaps] - 1)
+    back = d <= 0
+    _items(report, 'duplicate_pings', pings[1:][back], pings[:-1][back])
+    for name in 'num_samples', 'time_duration':
+        values = columns[name]
+        changed = np.flatnonzero(values[1:] != values[:-1]) + 1
+        _items(report, name + '_changes', pings[changed], values[changed])
+    return report
+
+def line_checks(columns, max_speed = MAX_SPEED, time_jump = TIME_JUMP):
+    """Time and navigation checks, one point per ping"""
+    report = {}
+    pings = columns['ping_number']
+    first = np.ones(len(pings), dtype = bool) # no pings: empty columns
+    first[1:] = pings[1:] != pings[:-1]
+    pings = pings[first]
+    t = xtf.ping_timestamps(columns)[first]
+    report['start'] = float(t.min()) if len(t) else None
+    report['end'] = float(t.max()) if len(t) else None
+
+    dt = np.diff(t)
+    limit = max(time_jump * np.median(dt[dt > 0]), 1.0) \
+            if (dt > 0).any() else 1.0
+    jumps = (dt < 0) | (dt > limit)
+    _items(report, 'time_jumps', pings[1:][jumps], dt[jumps])
+
+    lon = columns['ship_xcoordinate'][first]
+    lat = columns['ship_ycoordinate'][first]
+    fix = (lon != 0) | (lat != 0)
+    lon, lat, t, fixed_pings = lon[fix], lat[fix], t[fix], pings[fix]
+    dx = np.diff(lon) * np.cos(np.radians(lat[1:])) * xtf.METERS_PER_DEGREE
+    dy = np.diff(lat) * xtf.METERS_PER_DEGREE
+    speed = np.hypot(dx, dy) / np.maximum(np.diff(t), 0.01)
+    spikes = speed > max_speed
+    _items(report, 'nav_spikes', fixed_pings[1:][spikes], speed[spikes])
+    report['no_nav_pings'] = int((~fix).sum())
+    return report
+
+def amplitude_stats(channel):
+    """min, max, mean, rms and fraction of clipped samples of ChannelArray"""
+    n_pings, n_samples = channel.shape
+    if n_pings == 0 or n_samples == 0:
+        return None
+    limit = np.iinfo(channel.dtype).max
+    lo, hi, total, squares, clipped = limit, -limit - 1, 0.0, 0.0, 0
+    for start in range(0, n_pings, READ_PINGS):
+        block = channel[start:start + READ_PINGS]
+        lo = min(lo, int(block.min()))
+        hi = max(hi, int(block.max()))
+        block = block.astype(np.float64)
+        total += block.sum()
+        squares += np.square(block).sum()
+        clipped += int((np.abs(block) >= limit).sum())
+    n = float(n_pings * n_samples)
+    return dict(min = lo, max = hi, mean = total / n,
+                rms = (squares / n) ** 0.5, clipped = clipped / n)
+
+def check_file(infile, max_speed = MAX_SPEED, time_jump = TIME_JUMP):
+    """QC report of XTF file, as dict (see module docstring)"""
+    columns = xtf.read_ping_columns(infile, FIELDS)
+    report = dict(file = infile, channels = {})
+    report.update(line_checks(columns, max_speed, time_jump))
+    with xtf.open_reader(infile) as reader:
+        for number in range(len(reader.chaninfos)):
+            mine = columns['channel_number'] == number
+            channel = channel_checks(dict((name, values[mine])
+                                          for name, values in columns.items()))
+            channel['amplitude'] = amplitude_stats(reader.channel(number))
+            report['channels'][str(number)] = channel
+    report['ok'] = not any(report[name] for name in
+                           ['time_jumps_count', 'nav_spikes_count']) and \
+                   not any(channel[name] for channel in
+                           report['channels'].values() for name in
+                           ['ping_gaps_count', 'duplicate_pings_count',
+                            'num_samples_changes_count',
+                            'time_duration_changes_count'])
+    return report
+
+def _check_file(infile):
+    try:
+        return check_file(infile)
+    except Exception, e: # don't stop reports of other files
+        return dict(file = infile, ok = False,
+                    error = '%s: %s' % (type(e).__name__, e))
+
+def check_files(infiles, processes = None):
+    """QC reports of many files, made in a process pool"""
+    if len(infiles) == 1:
+        return [_check_file(infiles[0])]
+    pool = Pool(processes)
+    try:
+        return pool.map(_check_file, infiles)
+    finally:
+        pool.terminate()
+
+def write_report(reports, outfile):
+    with BackgroundWriter(outfile) as out:
+        out.write(json.dumps(reports, indent = 1, sort_keys = True))
+
+def main(outfile, infiles):
+    reports = check_files(infiles)
+    write_report(reports, outfile)
+    for report in reports:
+        print '%s: %s' % (report['file'], 'OK' if report['ok'] else
+                          report.get('error', 'problems found'))
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        sys.exit('Error: wrong arguments\n' + __doc__.rstrip())
+
+    main(sys.argv[1], sys.argv[2:])
@@ -1,6 +1,6 @@
 """sacker - convenient wrappers around struct.pack and struct.unpack"""
 
-from struct import Struct
+from struct import Struct, calcsize
 import re
 
 class Sacker(object):
@@ -87,6 +87,27 @@ def wrap(data, spec, endian = '<'):
     struct, names, tests, s_indices = parse(spec, endian)
     return struct.pack(*[data.get(name, 0) for name in names])
 
+def offsets(spec, endian = '<'):
+    r"""Byte offsets and struct formats of named fields in `spec`
+
+    Example:
+    >>> sorted(offsets('''H magic == 0xff !
+    ...                   4x
+    ...                   b byte''').items())
+    [('byte', (6, 'b')), ('magic', (0, 'H'))]
+    """
+
+    parse(spec, endian) # check syntax
+    result = {}
+    position = 0
+    for line in spec.split('\n'):
+        words = strip(line).split()
+        if words:
+            if len(words) > 1:
+                result[words[1]] = position, words[0]
+            position += calcsize(endian + words[0])
+    return result
+
 def strip(s):
     try:
         s = s[:s.index('#')]
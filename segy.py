@@ -10,16 +10,82 @@ from pprint import pprint
 import numpy as np
 
 from sacker import Sacker
+from fileio import BackgroundWriter, open_input
 
 # SEG-Y spec: http://www.tritonimaginginc.com/site/content/public/downloads/FileFormatInfo/seg_y_rev1.pdf
 
 SAMPLE_FORMATS = {
+    'ibm': 1, # 4-byte, IBM floating-point
     'f': 5, # 4-byte, IEEE floating-point
     'i': 2, # 4-byte, two's complement integer
     'h': 3, # 2-byte, two's complement integer
     'b': 8, # 1-byte, two's complement integer
 }
 
+# big-endian numpy dtypes of trace samples, by SEG-Y sample format code
+SAMPLE_DTYPES = {1: '>u4', 5: '>f4', 2: '>i4', 3: '>i2', 8: 'i1'}
+
+def ieee_to_ibm(a):
+    """Convert array of numbers to IBM 32-bit floats, returned as uint32 words
+
+    >>> ['%08x' % w for w in ieee_to_ibm(np.array([1.0, -118.625, 0.0]))]
+    ['41100000', 'c276a000', '00000000']
+    """
+    a = np.asarray(a, np.float64)
+    sign = (a < 0).astype(np.uint32) << 31
+    fraction, exponent = np.frexp(np.abs(a)) # a = fraction * 2**exponent
+
+    # a = fraction16 * 16**exponent16, 1/16 <= fraction16 < 1
+    exponent16 = (exponent + 3) // 4
+    fraction16 = np.ldexp(fraction, exponent - 4 * exponent16)
+    mantissa = np.round(np.ldexp(fraction16, 24)).astype(np.int64)
+    carry = mantissa >= 2**24 # rounding overflow
+    mantissa[carry] >>= 4
+    exponent16[carry] += 1
+
+    biased = exponent16 + 64
+    mantissa[biased > 127] = 2**24 - 1 # too large: the largest IBM float
+    mantissa[(biased < 0) | (a == 0)] = 0 # too small: zero
+    biased = np.clip(biased, 0, 127)
+    biased[mantissa == 0] = 0
+    return (sign | (biased.astype(np.uint32) << 24) |
+            mantissa.astype(np.uint32))
+
+def ibm_to_ieee(words):
+    """Convert array of IBM 32-bit floats (as uint32 words) to float32
+
+    >>> ibm_to_ieee(np.array([0x41100000, 0xc276a000], np.uint32)).tolist()
+    [1.0, -118.625]
+    """
+    words = np.asarray(words, np.uint32)
+    sign = np.where(words >> 31, -1.0, 1.0)
+    exponent = ((words >> 24) & 0x7f).astype(np.int32)
+    mantissa = (words & 0xffffff).astype(np.float64)
+    return (sign * np.ldexp(mantissa, 4 * (exponent - 64) - 24)).astype(
+                                                                   np.float32)
+
+def encode_samples(traces, sample_format):
+    """Convert samples to `sample_format` (SAMPLE_FORMATS key) for SEGYWriter
+
+    Integer formats are rounded and clipped, 'ibm' gives uint32 words.
+    """
+    if sample_format == 'ibm':
+        return ieee_to_ibm(traces)
+    dtype = np.dtype(sample_format)
+    if traces.dtype == dtype:
+        return traces
+    if dtype.kind == 'i':
+        info = np.iinfo(dtype)
+        traces = np.clip(np.round(traces), info.min, info.max)
+    return traces.astype(dtype)
+
+def decode_samples(data, sample_format):
+    """Decode trace samples, `sample_format` - SEG-Y sample format code"""
+    samples = np.frombuffer(data, SAMPLE_DTYPES[sample_format])
+    if sample_format == 1:
+        return ibm_to_ieee(samples)
+    return samples.astype(samples.dtype.newbyteorder('='))
+
 SEGY_HEADER = Sacker('>', '''
     I job_id                   # Job identification number
     i line_num                 # Line number
@@ -150,29 +216,70 @@ def encode_text(s):
                 for line in s.split('\n')).ljust(TEXT_LEN,' ')
     return t.encode('ibm037')
 
-def write_SEGY(outfile, file_header, text, traces):
-    with open(outfile, 'wb') as out:
-        out.write(encode_text(text))
-        out.write(SEGY_HEADER.wrap(file_header))
+class SEGYWriter(object):
+    """Write SEG-Y file trace by trace. See write_SEGY.
+
+    Usage:
+        with SEGYWriter(outfile, file_header, text) as out:
+            out.write_trace(header, data)
+    """
+
+    def __init__(self, outfile, file_header, text, sync = False):
+        self.out = BackgroundWriter(outfile, sync = sync)
+        self.out.write(encode_text(text))
+        self.out.write(SEGY_HEADER.wrap(file_header))
+
+    def write_trace(self, header, data):
+        self.out.write(TRACE_HEADER.wrap(header))
+        self.out.write(np.getbuffer(data.byteswap()))
+
+    def finish(self):
+        """Write all traces without renaming, see BackgroundWriter.finish"""
+        self.out.finish()
+
+    def close(self):
+        self.out.close()
+
+    def abort(self):
+        self.out.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.out.__exit__(type, value, traceback)
+
+def write_SEGY(outfile, file_header, text, traces, sync = False):
+    """Write SEG-Y file. `outfile` appears only if writing succeeds.
+
+    traces - iterable of (trace_header, numpy_array) tuples
+    sync - fsync() file to disk before renaming it to `outfile`
+    """
+    with SEGYWriter(outfile, file_header, text, sync = sync) as out:
         for header, data in traces:
-            out.write(TRACE_HEADER.wrap(header))
-            out.write(np.getbuffer(data.byteswap()))
+            out.write_trace(header, data)
 
 def read_SEGY(infile):
-    file_data = memoryview(open(infile, 'rb').read())
+    with open_input(infile) as f:
+        file_data = memoryview(f.read())
     print decode_text(file_data[:TEXT_LEN].tobytes())
     data = file_data[TEXT_LEN:]
     header_len, header = SEGY_HEADER.unwrap(data, data_factory = OrderedDict)
     pprint([(k, v) for k, v in header.items() if v != 0])
 
+    sample_format = header['sample_format']
+    sample_size = np.dtype(SAMPLE_DTYPES[sample_format]).itemsize
+
     i = 0
     data = data[header_len:]
     while data:
         trace_len, trace = TRACE_HEADER.unwrap(data, data_factory = OrderedDict)
         print 'TRACE', i, '[%d]' % trace['trace_num_in_orig_record'],
         pprint([(k, v) for k, v in trace.items() if v != 0])
-        print np.frombuffer(data[trace_len:trace_len + trace['n_samples']*2].tobytes(), np.int16).byteswap()
-        data = data[trace_len + trace['n_samples'] * 2:]
+        data_len = trace['n_samples'] * sample_size
+        print decode_samples(data[trace_len:trace_len + data_len].tobytes(),
+                             sample_format)
+        data = data[trace_len + data_len:]
         i += 1
         if i > 10:
             break
@@ -0,0 +1,217 @@
+"""spatial - spatial index of survey lines for fast area queries
+
+Index keeps simplified ship track of every XTF file and a grid of cells
+(CELL_SIZE degrees), each cell listing files with track segments crossing it.
+It's saved as JSON next to project file, see index_path.
+
+Usage:
+    index = SpatialIndex.load(index_path(project_file))
+    index.update(filenames, project_dir) # only new or changed files are read
+    index.save()
+    index.query_bbox(lon1, lat1, lon2, lat2)
+    index.nearest(lon, lat)
+"""
+
+import os
+import json
+from math import cos, radians
+
+import numpy as np
+
+import xtf
+
+CELL_SIZE = 0.01 # degrees, ~1 km
+TRACK_TOLERANCE = 10.0 # m, maximum deviation of stored tracks from real ones
+
+def index_path(project_file):
+    return os.path.splitext(project_file)[0] + '.spatial.json'
+
+def track_points(infile, tolerance = TRACK_TOLERANCE, skipped = None):
+    """Simplified ship track of XTF file: (n, 2) array of (lon, lat)
+
+    skipped - list to turn on recovery mode, see xtf.index_packets
+    """
+    track = xtf.read_track(infile, skipped)
+    keep = xtf.simplify_track(track.lons, track.lats, tolerance)
+    return np.column_stack([track.lons[keep], track.lats[keep]])
+
+def segment_cells(points, cell_size = CELL_SIZE):
+    """Set of grid cells (i, j) touched by bounding boxes of track segments"""
+    if len(points) == 1:
+        points = np.vstack([points, points])
+    lo = np.floor(np.minimum(points[:-1], points[1:]) / cell_size).astype(int)
+    hi = np.floor(np.maximum(points[:-1], points[1:]) / cell_size).astype(int)
+    cells = set(zip(lo[:, 0], lo[:, 1]))
+    for (i0, j0), (i1, j1) in zip(lo[(hi != lo).any(axis = 1)],
+                                  hi[(hi != lo).any(axis = 1)]):
+        cells.update((i, j) for i in range(i0, i1 + 1)
+                            for j in range(j0, j1 + 1))
+    return cells
+
+def segments_cross_bbox(points, (x0, y0, x1, y1)):
+    """True if any segment of polyline `points` crosses box"""
+    if len(points) == 1:
+        points = np.vstack([points, points])
+    a, b = points[:-1], points[1:]
+
+    # segment bounding boxes must overlap the box
+    overlap = ((np.maximum(a[:, 0], b[:, 0]) >= x0) &
+               (np.minimum(a[:, 0], b[:, 0]) <= x1) &
+               (np.maximum(a[:, 1], b[:, 1]) >= y0) &
+               (np.minimum(a[:, 1], b[:, 1]) <= y1))
+    a, b = a[overlap], b[overlap]
+
+    # and box corners must not all be on one side of segment line
+    d = b - a
+    sides = np.array([d[:, 0] * (y - a[:, 1]) - d[:, 1] * (x - a[:, 0])
+                      for x, y in [(x0, y0), (x0, y1), (x1, y0), (x1, y1)]])
+    return bool(((sides.min(axis = 0) <= 0) & (sides.max(axis = 0) >= 0)).any())
+
+def distance_to_track(points, lon, lat):
+    """Distance (m) from point to polyline, in local equirectangular projection"""
+    scale = np.array([cos(radians(lat)), 1.0]) * xtf.METERS_PER_DEGREE
+    p = (points - (lon, lat)) * scale
+    if len(p) == 1:
+        return float(np.hypot(*p[0]))
+    a, d = p[:-1], p[1:] - p[:-1]
+    length2 = (d ** 2).sum(axis = 1)
+    t = np.clip(-(a * d).sum(axis = 1) / np.where(length2 > 0, length2, 1),
+                0, 1)
+    return float(np.hypot(*(a + d * t[:, np.newaxis]).T).min())
+
+class SpatialIndex(object):
+    """Grid index of survey line tracks (see module docstring)"""
+
+    def __init__(self, path = None, cell_size = CELL_SIZE):
+        self.path = path
+        self.cell_size = cell_size
+        self.lines = {} # filename -> dict(mtime, size, points)
+        self.grid = {} # (i, j) -> set of filenames
+        self.errors = {} # filename -> error message of the last update
+        self.damaged = {} # filename -> byte ranges skipped in the last update
+
+    @classmethod
+    def load(cls, path):
+        """Load index from `path`, or return empty one if there's none"""
+        if not os.path.exists(path):
+            return cls(path)
+        with open(path) as f:
+            data = json.load(f)
+        index = cls(path, data['cell_size'])
+        for name, line in data['lines'].items():
+            index._add(name, line['mtime'], line['size'],
+                       np.array(line['points'], dtype = float).reshape(-1, 2))
+        return index
+
+    def save(self, path = None):
+        self.path = path or self.path
+        data = dict(cell_size = self.cell_size,
+                    lines = dict((name, dict(mtime = line['mtime'],
+                                             size = line['size'],
+                                             points = line['points'].tolist()))
+                                 for name, line in self.lines.items()))
+        with open(self.path, 'w') as f:
+            json.dump(data, f)
+
+    def _add(self, name, mtime, size, points):
+        self.remove(name)
+        self.lines[name] = dict(mtime = mtime, size = size, points = points)
+        if len(points):
+            for cell in segment_cells(points, self.cell_size):
+                self.grid.setdefault(cell, set()).add(name)
+
+    def remove(self, name):
+        if self.lines.pop(name, None) is not None:
+            for names in self.grid.values():
+                names.discard(name)
+
+    def update(self, filenames, base_dir = ''):
+        """Index new or changed files, return number of files (re)indexed
+
+        filenames - names to store in index, relative to base_dir
+
+        Damaged files are read in recovery mode (see `damaged`). Files that
+        can't be read are left out, see `errors`.
+        """
+        self.errors.clear()
+        self.damaged.clear()
+        n = 0
+        for name in filenames:
+            path = os.path.join(base_dir, name)
+            skipped = []
+            try:
+                st = os.stat(path)
+                line = self.lines.get(name)
+                if line and (line['mtime'], line['size']) == (st.st_mtime,
+                                                              st.st_size):
+                    continue
+                points = track_points(path, skipped = skipped)
+            except Exception, e: # any error only leaves this file out
+                self.errors[name] = '%s: %s' % (type(e).__name__, e)
+                self.remove(name)
+                continue
+            if skipped:
+                self.damaged[name] = skipped
+            self._add(name, st.st_mtime, st.st_size, points)
+            n += 1
+        return n
+
+    def _cells(self, (i0, j0, i1, j1)):
+        names = set()
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self.grid): # huge area
+            for (i, j), cell_names in self.grid.items():
+                if i0 <= i <= i1 and j0 <= j <= j1:
+                    names.update(cell_names)
+        else:
+            for i in range(i0, i1 + 1):
+                for j in range(j0, j1 + 1):
+                    names.update(self.grid.get((i, j), ()))
+        return names
+
+    def _ring(self, i, j, r):
+        """Files in cells exactly `r` cells away from (i, j)"""
+        if r == 0:
+            return self._cells((i, j, i, j))
+        return (self._cells((i - r, j - r, i + r, j - r)) |
+                self._cells((i - r, j + r, i + r, j + r)) |
+                self._cells((i - r, j - r + 1, i - r, j + r - 1)) |
+                self._cells((i + r, j - r + 1, i + r, j + r - 1)))
+
+    def query_bbox(self, lon1, lat1, lon2, lat2):
+        """Sorted list of files with tracks crossing the box"""
+        box = (min(lon1, lon2), min(lat1, lat2),
+               max(lon1, lon2), max(lat1, lat2))
+        cells = [int(np.floor(v / self.cell_size)) for v in box]
+        return sorted(name for name in self._cells(cells)
+                      if segments_cross_bbox(self.lines[name]['points'], box))
+
+    def nearest(self, lon, lat, max_distance = None):
+        """(filename, distance in meters) of the nearest track, or None
+
+        Search goes in growing rings of cells, up to `max_distance` (m).
+        """
+        i, j = [int(np.floor(v / self.cell_size)) for v in (lon, lat)]
+        cell_m = (self.cell_size * xtf.METERS_PER_DEGREE *
+                  max(cos(radians(lat)), 0.01))
+        best = None
+        seen = set()
+        r = 0
+        while len(seen) < len(self.lines):
+            if (2 * r + 1) ** 2 > len(self.grid):
+                names = set(self.lines) - seen # faster to check all the rest
+            else:
+                names = self._ring(i, j, r) - seen
+            seen.update(names)
+            for name in names:
+                d = distance_to_track(self.lines[name]['points'], lon, lat)
+                if best is None or d < best[1]:
+                    best = name, d
+            # anything not seen yet is at least r cells away
+            if best is not None and best[1] <= r * cell_m:
+                break
+            if max_distance is not None and r * cell_m > max_distance:
+                break
+            r += 1
+        if best is not None and (max_distance is None or
+                                 best[1] <= max_distance):
+            return best
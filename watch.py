@@ -0,0 +1,178 @@
+"""watch - convert new XTF files appearing in a directory
+
+Directory is polled every POLL_INTERVAL seconds. A file is converted when
+its size and modification time haven't changed for STABLE_TIME seconds
+(recording has finished). Conversions run in a process pool. Results are
+kept in a SQLite database in output directory (see STATE_DB), so after
+restart only new, changed or unfinished files are converted, and those
+that failed for other reasons than bad data (e.g. unreachable share).
+Output files appear only when complete, so an interrupted conversion is
+simply redone.
+
+From command line:
+    python watch.py <watch-dir> <output-dir> [segy | xtf]
+"""
+
+import os
+import re
+import sys
+import time
+import sqlite3
+from multiprocessing import Pool
+
+import numpy as np
+
+import xtf
+from fileio import open_input
+from xtfformat import HEADER_LEN, read_header
+
+POLL_INTERVAL = 10 # seconds
+STABLE_TIME = 60 # seconds without file changes before conversion
+STATE_DB = '.watch.sqlite'
+
+EXT_RE = re.compile(r'\.xtf(\.gz|\.xz|\.zblk)?$', re.I)
+FORMATS = {'segy': '.seg', 'xtf': '.xtf'}
+
+def all_channels(infile):
+    """Numbers of channels that have pings (header may declare more)"""
+    with open_input(infile) as f:
+        header, chaninfos = read_header(f.read(HEADER_LEN))
+    columns = xtf.read_ping_columns(infile, ['channel_number'], skipped = [])
+    return [ch for ch in np.unique(columns['channel_number']).tolist()
+            if ch < len(chaninfos)]
+
+def convert((infile, outfile, format, channel_numbers)):
+    """Pool worker: return (skipped byte ranges, error or None, status)
+
+    Errors of all kinds are returned. Bad data fails the file for good,
+    other errors (status 'error') are retried after restart.
+    """
+    skipped = []
+    try:
+        if channel_numbers is None:
+            channel_numbers = all_channels(infile)
+        if format == 'segy':
+            xtf.export_SEGY(infile, outfile, channel_numbers,
+                            skipped = skipped)
+        else:
+            xtf.export_XTF(infile, outfile, channel_numbers,
+                           skipped = skipped)
+    except Exception, e:
+        # any error only fails this file, it mustn't stop the watcher
+        return (skipped, '%s: %s' % (type(e).__name__, e),
+                'failed' if isinstance(e, xtf.BadDataError) else 'error')
+    return skipped, None, 'done'
+
+class State(object):
+    """Converted files database: path, size, mtime, status, error
+
+    status - 'done', 'failed' (bad data, not retried) or 'error'
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS files (
+                               path TEXT PRIMARY KEY,
+                               size INTEGER,
+                               mtime REAL,
+                               status TEXT,
+                               error TEXT,
+                               converted_at REAL)''')
+        self.db.commit()
+
+    def is_done(self, path, size, mtime):
+        row = self.db.execute('SELECT size, mtime, status FROM files '
+                              'WHERE path = ?', (path,)).fetchone()
+        return row is not None and row[:2] == (size, mtime) and \
+               row[2] in ('done', 'failed')
+
+    def record(self, path, size, mtime, status, error):
+        self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                        (path, size, mtime, status, error, time.time()))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+class Watcher(object):
+    """Poll `watch_dir`, convert stable XTF files to `out_dir`"""
+
+    def __init__(self, watch_dir, out_dir, format = 'segy',
+                       channel_numbers = None, stable_time = STABLE_TIME,
+                       processes = None):
+        self.watch_dir = watch_dir
+        self.out_dir = out_dir
+        self.format = format
+        self.ext = FORMATS[format]
+        self.channel_numbers = channel_numbers
+        self.stable_time = stable_time
+        self.state = State(os.path.join(out_dir, STATE_DB))
+        self.pool = Pool(processes)
+        self.seen = {} # path -> (size, mtime, time of last change)
+        self.running = {} # path -> (size, mtime, AsyncResult)
+        self.errors = {} # path -> (size, mtime) of errors retried on restart
+
+    def poll(self):
+        """Check directory once: collect finished work, start new"""
+        for path, (size, mtime, result) in self.running.items():
+            if result.ready():
+                del self.running[path]
+                skipped, error, status = result.get()
+                self.state.record(path, size, mtime, status, error)
+                if status == 'error':
+                    self.errors[path] = size, mtime
+                if skipped:
+                    log('%s: damaged data skipped, bytes: %s' % (path,
+                        ', '.join('%d-%d' % r for r in skipped)))
+                log('%s: %s' % (path, error or 'converted'))
+
+        now = time.time()
+        for name in sorted(os.listdir(self.watch_dir)):
+            if not EXT_RE.search(name):
+                continue
+            path = os.path.join(self.watch_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue # removed meanwhile
+            key = st.st_size, st.st_mtime
+            if self.seen.get(path, (None, None))[:2] != key:
+                self.seen[path] = key + (now,)
+                continue
+            if (path in self.running or
+                    now - self.seen[path][2] < self.stable_time or
+                    self.errors.get(path) == key or
+                    self.state.is_done(path, *key)):
+                continue
+            outfile = os.path.join(self.out_dir, EXT_RE.sub('', name) +
+                                                 self.ext)
+            log('%s: converting to %s' % (path, outfile))
+            self.running[path] = key + (self.pool.apply_async(convert,
+                    [(path, outfile, self.format, self.channel_numbers)]),)
+
+    def run(self, poll_interval = POLL_INTERVAL):
+        try:
+            while True:
+                self.poll()
+                time.sleep(poll_interval)
+        finally:
+            self.close()
+
+    def close(self):
+        self.pool.terminate()
+        self.state.close()
+
+def log(message):
+    print '%s %s' % (time.strftime('%Y-%m-%d %H:%M:%S'), message)
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4) or sys.argv[3:] not in ([], ['segy'],
+                                                              ['xtf']):
+        sys.exit('Error: wrong arguments\n' + __doc__.rstrip())
+
+    watcher = Watcher(sys.argv[1], sys.argv[2], *sys.argv[3:])
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
@@ -2,127 +2,81 @@
 
 From command line:
     python xtf.py <path-to-xtf-file>
+
+For a quick summary of many files see xtfinfo.py.
 """
 
 import sys
+import struct
+import csv
+import json
+import copy
+import time
+import threading
 from pprint import pprint, pformat
 from collections import OrderedDict, namedtuple
 from itertools import groupby, islice, chain
+from bisect import bisect_right
 from getpass import getuser
-from datetime import datetime
+from datetime import datetime, timedelta
 from string import Template
 import re
 
 import numpy as np
 
 import version
-from sacker import wrap, unwrap, BadDataError
+from sacker import wrap, unwrap, offsets, parse, BadDataError
+from fileio import (BackgroundWriter, open_input, map_input, split_ext,
+                    CHUNK_SIZE)
 import segy
-
-# XTF spec: http://www.tritonimaginginc.com/site/content/public/downloads/FileFormatInfo/Xtf%20File%20Format_X35.pdf
-
-CHAN_TYPES = {
-    0: 'subbottom',
-    1: 'port',
-    2: 'stbd',
-    3: 'bathymetry',
-}
-CHANINFO_LEN = 128
-HEADER_TYPES = {
-    0: 'sonar', # sidescan and subbottom
-    1: 'notes', # notes - text annotation
-    2: 'bathy', # bathymetry (Seabat, Odom)
-    3: 'attitude', # TSS or MRU attitude (pitch, roll, heave, yaw)
-    4: 'forward', # forward-look sonar (polar display)
-    5: 'elac', # Elac multibeam
-    6: 'raw_serial', # Raw data from serial port
-    7: 'embed_head', # Embedded header structure
-    8: 'hidden_sonar', # hidden (non-displayable) ping
-}
-HEADER_LEN = 1024
-
-HEADER = """
-    B file_format == 0x7b !
-    B system_type
-    8s recording_program_name
-    8s recording_program_version
-    16s sonar_name
-    H sonar_type
-    64s note_string
-    64s this_file_name
-    H nav_units
-    H number_of_sonar_channels
-    H number_of_bathymetry_channels
-    B number_of_snippet_channels
-    B number_of_forward_look_arrays
-    H number_of_echo_strength_channels
-    B number_of_interferometry_channels
-    B reserved1
-    H reserved2
-    f reference_point_height
-    12s projection_type
-    10s spheroid_type
-    l navigation_latency
-    f origin_x
-    f origin_y
-    f nav_offset_y
-    f nav_offset_x
-    f nav_offset_z
-    f nav_offset_yaw
-    f MRU_offset_y
-    f MRU_offset_x
-    f MRU_offset_z
-    f MRU_offset_yaw
-    f MRU_offset_pitch
-    f MRU_offset_roll
-"""
-
-CHANINFO = """
-    B type_of_channel
-    B sub_channel_number
-    H correction_flags
-    H uni_polar
-    H bytes_per_sample
-    I reserved1
-    16s channel_name
-    f volt_scale
-    f frequency
-    f horiz_beam_angle
-    f tilt_angle
-    f beam_width
-    f offset_x
-    f offset_y
-    f offset_z
-    f offset_yaw
-    f offset_pitch
-    f offset_roll
-    H beams_per_array
-    54s reserved2
-"""
-
-def read_XTF(infile, packet_filter):
-    file_data = memoryview(open(infile, 'rb').read())
-    header_len, header = unwrap(file_data, HEADER, data_factory = OrderedDict)
-    nchannels = (header['number_of_sonar_channels'] +
-                 header['number_of_bathymetry_channels'])
-    assert nchannels <= 6
-    chaninfos = []
-    for i in range(nchannels):
-        chaninfo_len, chaninfo = unwrap(file_data[header_len+i*CHANINFO_LEN:],
-                                        CHANINFO)
-        assert chaninfo_len == CHANINFO_LEN
-        chaninfos.append(chaninfo)
+# names from xtfformat are part of xtf's interface, even if unused here
+from xtfformat import (CHAN_TYPES, CHANINFO_LEN, HEADER_TYPES, HEADER_LEN,
+                       HEADER, CHANINFO, PACKET_HEADER, SONAR_HEADER,
+                       SONAR_CHANNEL_HEADER, NOTES_HEADER, ATTITUDE_HEADER,
+                       PACKET_HEADER_LEN,
+                       read_header, header_type, scan_packets,
+                       read_packets_forward, ping_datetime)
+
+def read_XTF(infile, packet_filter, skipped = None, markers = None):
+    """Read XTF file: return (header, chaninfos, packets iterator)
+
+    skipped - list to turn on recovery mode, see index_packets
+    markers - MarkerIndex, filled while packets are parsed (whatever the
+              `packet_filter`), complete when the iterator is exhausted
+    """
+    with open_input(infile) as f:
+        raw = f.read()
+    file_data = memoryview(raw)
+    header, chaninfos = read_header(file_data)
 
     pstart = HEADER_LEN
-    return header, chaninfos, packets_gen(file_data[pstart:], chaninfos,
-                                          packet_filter)
+    if skipped is None:
+        packets = packets_gen(file_data[pstart:], chaninfos, packet_filter,
+                              markers, pstart)
+    else:
+        # parse good parts between the damaged ones
+        damaged = []
+        index_packets(raw, pstart, chaninfos, damaged)
+        skipped.extend(damaged)
+        starts = [pstart] + [end for start, end in damaged]
+        ends = [start for start, end in damaged] + [len(raw)]
+        packets = chain.from_iterable(packets_gen(file_data[start:end],
+                                                  chaninfos, packet_filter,
+                                                  markers, start)
+                                      for start, end in zip(starts, ends)
+                                      if start < end)
+    return header, chaninfos, packets
 
 def pad(s, width):
     assert len(s) <= width
     return s.ljust(width, '\x00')
 
-def write_XTF(outfile, header, chaninfos, packets):
-    with open(outfile, 'wb') as out:
+def write_XTF(outfile, header, chaninfos, packets, sync = False):
+    """Write XTF file. `outfile` appears only if writing succeeds.
+
+    sync - fsync() file to disk before renaming it to `outfile`
+    """
+    with BackgroundWriter(outfile, sync = sync) as out:
         out.write(pad(''.join([wrap(header, HEADER)] +
                               [wrap(c, CHANINFO) for c in chaninfos]),
                       HEADER_LEN))
@@ -146,6 +100,8 @@ TraceHeader = namedtuple('TraceHeader', '''channel_number
     layback cable_out slant_range time_delay seconds_per_ping num_samples''')
 
 Packet = namedtuple('Packet', 'pheader raw')
+NotesPacket = namedtuple('NotesPacket', 'pheader nheader raw')
+AttitudePacket = namedtuple('AttitudePacket', 'pheader aheader raw')
 
 class SonarPacket(namedtuple('SonarPacket',
                              'pheader sheader cheader trace raw_trace')):
@@ -181,132 +137,28 @@ class SonarPacket(namedtuple('SonarPacket',
     def channel_number(self):
         return self.cheader['channel_number']
 
-def header_type(pheader):
-    return HEADER_TYPES.get(pheader['header_type'],
-                                   'UNKNOWN (%d)' % pheader['header_type'])
-
-PACKET_HEADER = """
-    H magic_number == 0xFACE !
-    B header_type
-    B sub_channel_number
-    H num_chans_to_follow
-    4s reserved1
-    I num_bytes_this_record
-"""
-
-SONAR_HEADER = """
-    H year
-    B month
-    B day
-    B hour
-    B minute
-    B second
-    B hseconds
-    H julian_day
-    I event_number
-    I ping_number
-    f sound_velocity
-    f ocean_tide
-    I reserved2
-    f conductiviy_freq
-    f temperature_freq
-    f pressure_freq
-    f pressure_temp
-    f conductivity
-    f water_temperature
-    f pressure
-    f computed_sound_velocity
-    f mag_x
-    f mag_y
-    f mag_z
-    f aux_val1
-    f aux_val2
-    f aux_val3
-    f aux_val4
-    f aux_val5
-    f aux_val6
-    f speed_log
-    f turbidity
-    f ship_speed
-    f ship_gyro
-    d ship_ycoordinate
-    d ship_xcoordinate
-    H ship_alititude
-    H ship_depth
-    B fix_time_hour
-    B fix_time_minute
-    B fix_time_second
-    B fix_time_hsecond
-    f sensor_speed
-    f KP
-    d sensor_ycoordinate
-    d sensor_xcoordinate
-    H sonar_status
-    H range_to_fish
-    H bearing_to_fish
-    H cable_out
-    f layback
-    f cable_tension
-    f sensor_depth
-    f sensor_primary_altitude
-    f sensor_aux_altitude
-    f sensor_pitch
-    f sensor_roll
-    f sensor_heading
-    f heave
-    f yaw
-    I attitude_time_lag
-    f DOT
-    I nav_fix_milliseconds
-    B computer_clock_hour
-    B computer_clock_minute
-    B computer_clock_second
-    B computer_clock_hsec
-    h fish_position_delta_x
-    h fish_position_delta_y
-    B fish_position_error_code
-    11s reserved3
-"""
-
-SONAR_CHANNEL_HEADER = """
-    H channel_number
-    H downsample_method
-    f slant_range
-    f ground_range
-    f time_delay
-    f time_duration
-    f seconds_per_ping
-    H processing_flags
-    H frequency
-    H initial_gain_code
-    H gain_code
-    H band_width
-    I contact_number
-    H contact_classification
-    B contact_sub_number
-    b contact_type
-    I num_samples
-    H millivolt_scale
-    f contact_time_of_track
-    B contact_close_number
-    B reserved2
-    f fixed_VSOP
-    h weight
-    4s reserved
-"""
+def packets_gen(data, chaninfos, packet_filter, markers = None,
+                                                offset = HEADER_LEN):
+    """Parse packets of `data`, yield those of `packet_filter` type ('*' for
+    all)
 
-def packets_gen(data, chaninfos, packet_filter):
+    markers - MarkerIndex to add notes and event number changes to, while
+              parsing (`offset` - file offset of `data`)
+    """
     i = 0
     while data:
         pheader_len, pheader = unwrap(data, PACKET_HEADER)
         type = header_type(pheader)
+        wanted = packet_filter == '*' or type == packet_filter.lower()
 
-        if packet_filter == '*' or type == packet_filter.lower():
-            if type == 'sonar':
-                sheader_len, sheader = unwrap(data[pheader_len:],
-                                              SONAR_HEADER, 'XTFPINGHEADER')
-                assert pheader_len + sheader_len == 256
+        if type == 'sonar' and (wanted or markers is not None):
+            sheader_len, sheader = unwrap(data[pheader_len:],
+                                          SONAR_HEADER, 'XTFPINGHEADER')
+            assert pheader_len + sheader_len == 256
+            if markers is not None:
+                markers.add_ping(offset, sheader)
 
+            if wanted:
                 assert pheader['num_chans_to_follow'] <= 6
                 if pheader['num_chans_to_follow'] > 1:
                     raise NotImplementedError('Multiple channels in a packet')
@@ -325,20 +177,20 @@ def packets_gen(data, chaninfos, packet_filter):
                 trace = np.frombuffer(raw_trace, {1: np.int8, 2: np.int16}[s])
 
                 yield SonarPacket(pheader, sheader, cheader, trace, raw_trace)
-            #elif type == 'notes':
-            #    nheader_len, nheader = unwrap(data[pheader_len:],
-            #                                  """H year
-            #                                     B month
-            #                                     B day
-            #                                     B hour
-            #                                     B minute
-            #                                     B second
-            #                                     35s reserved
-            #                                     200s notes_text
-            #                                  """)
-            #    pprint(nheader)
-            #    assert nheader_len + pheader_len == \
-            #        pheader['num_bytes_this_record']
+        elif type == 'notes' and (wanted or markers is not None):
+            n = pheader['num_bytes_this_record']
+            nheader_len, nheader = unwrap(data[pheader_len:n],
+                                          NOTES_HEADER, 'XTFNOTESHEADER')
+            if markers is not None:
+                markers.add_note(offset, nheader)
+            if wanted:
+                yield NotesPacket(pheader, nheader, data[:n])
+        elif wanted:
+            if type == 'attitude':
+                n = pheader['num_bytes_this_record']
+                aheader_len, aheader = unwrap(data[pheader_len:n],
+                                              ATTITUDE_HEADER, 'XTFATTITUDEDATA')
+                yield AttitudePacket(pheader, aheader, data[:n])
             else:
                 yield Packet(pheader, data[:pheader['num_bytes_this_record']])
 
@@ -350,33 +202,1050 @@ def packets_gen(data, chaninfos, packet_filter):
             sys.stdout.flush()
 
         data = data[pheader['num_bytes_this_record']:]
+        offset += pheader['num_bytes_this_record']
         i += 1
 
+    if markers is not None:
+        markers.end = offset
     sys.stdout.write('\n')
 
-def read_XTF_as_grayscale_arrays(infile):
-    header, chaninfos, packets = read_XTF(infile, 'sonar')
-    return header, len(chaninfos), grayscale_arrays_gen(packets, chaninfos)
+PACKET_MAGIC = '\xce\xfa' # 0xFACE, little-endian
+PACKET_HEADER_STRUCT = parse(PACKET_HEADER, '<')[0]
+
+def packet_ok(data, offset, chaninfos = None, resync = False):
+    """Check that `data` has plausible complete packet at `offset`
+
+    Header magic and length must be right. Sonar packets must also have
+    known channel (if `chaninfos` are given) and samples inside.
+
+    resync - `offset` is a guess (see find_packet), so the packet must also
+             be followed by another packet header or the end of data
+    """
+    if offset + PACKET_HEADER_LEN > len(data):
+        return False
+    magic, type, sub, nchans, reserved, n = \
+                                PACKET_HEADER_STRUCT.unpack_from(data, offset)
+    if (magic != 0xFACE or n < PACKET_HEADER_LEN or
+            offset + n > len(data)):
+        return False
+    if (resync and offset + n < len(data) and
+            data[offset + n:offset + n + 2] != PACKET_MAGIC):
+        return False
+    if type == 1:
+        return n >= 256
+    if type == 0:
+        if not 1 <= nchans <= 6 or n < 256 + 64 * nchans:
+            return False
+        if chaninfos is not None:
+            channel = field(data, offset, 'channel_number')
+            if channel >= len(chaninfos):
+                return False
+            bytes_per_sample = chaninfos[channel]['bytes_per_sample']
+            samples = field(data, offset, 'num_samples')
+            if 256 + 64 * nchans + samples * bytes_per_sample > n:
+                return False
+    return True
+
+def find_packet(data, offset, chaninfos = None):
+    """Offset of the next packet_ok() packet at or after `offset`
+
+    Candidates are found with str.find (or mmap.find) of the magic number.
+    Return len(data) if nothing is found.
+    """
+    while True:
+        offset = data.find(PACKET_MAGIC, offset)
+        if offset < 0:
+            return len(data)
+        if packet_ok(data, offset, chaninfos, resync = True):
+            return offset
+        offset += 1
+
+def index_packets(data, offset = HEADER_LEN, chaninfos = None,
+                                              skipped = None):
+    """Scan packet headers of XTF file `data` (string or mmap)
+
+    Return (offsets, header_types, end): arrays describing complete packets
+    and offset right after the last complete one.
+
+    skipped - in recovery mode (list instead of None) damaged packets and
+              truncated last packet don't raise BadDataError. Scanning goes
+              on from the next plausible packet (see find_packet) and
+              (start, end) offsets of skipped data are appended to the list.
+    """
+    unpack = PACKET_HEADER_STRUCT.unpack_from
+    offsets, types = [], []
+    size = len(data)
+    while offset + PACKET_HEADER_LEN <= size:
+        if skipped is not None and not packet_ok(data, offset, chaninfos):
+            next = find_packet(data, offset + 1, chaninfos)
+            skipped.append((offset, next))
+            offset = next
+            continue
+        magic, type, sub, nchans, reserved, n = unpack(data, offset)
+        if magic != 0xFACE or n < PACKET_HEADER_LEN:
+            raise BadDataError('Bad packet header at %d' % offset)
+        if offset + n > size:
+            break
+        offsets.append(offset)
+        types.append(type)
+        offset += n
+    end = offset
+    if skipped is not None and offset < size:
+        skipped.append((offset, size))
+        end = size
+    return (np.array(offsets, dtype = np.int64),
+            np.array(types, dtype = np.uint8), end)
+
+# numpy types of struct formats
+DTYPES = {'B': '<u1', 'b': '<i1', 'H': '<u2', 'h': '<i2', 'I': '<u4',
+          'i': '<i4', 'l': '<i4', 'f': '<f4', 'd': '<f8'}
+
+# offsets and formats of sonar packet fields, from the packet start
+PING_FIELDS = {}
+for start, spec in [(0, PACKET_HEADER),
+                    (PACKET_HEADER_LEN, SONAR_HEADER),
+                    (256, SONAR_CHANNEL_HEADER)]:
+    for name, (offset, format) in offsets(spec).items():
+        PING_FIELDS.setdefault(name, (start + offset, format))
+
+def field(data, offset, name):
+    """Value of PING_FIELDS field of sonar packet at `offset`"""
+    field_offset, format = PING_FIELDS[name]
+    return struct.unpack_from('<' + format, data, offset + field_offset)[0]
+
+# offsets and formats of attitude packet fields, from the packet start
+ATTITUDE_FIELDS = dict((name, (PACKET_HEADER_LEN + offset, format))
+                       for name, (offset, format)
+                       in offsets(ATTITUDE_HEADER).items()
+                       if not name.startswith('reserved'))
+
+def ping_columns(data, offsets, fields, packet_fields = PING_FIELDS):
+    """Read fields of sonar packets at `offsets` as {name: array} columns
+
+    Fields are gathered from fixed offsets, without parsing packets.
+    packet_fields - ATTITUDE_FIELDS for attitude packets
+    """
+    data = np.frombuffer(data, np.uint8)
+    columns = {}
+    for name in fields:
+        offset, format = packet_fields[name]
+        dtype = np.dtype(DTYPES[format])
+        index = offsets[:, np.newaxis] + (offset + np.arange(dtype.itemsize))
+        columns[name] = data[index].view(dtype).ravel()
+    return columns
+
+def read_ping_columns(infile, fields, attitude = None, skipped = None):
+    """Read fields of all sonar packets of XTF file, see ping_columns
+
+    attitude - AttitudeSeries to add attitude packets to, from the same
+               packet index
+    skipped - list to turn on recovery mode, see index_packets
+    """
+    data = map_input(infile)
+    if skipped is None:
+        offsets, types, end = index_packets(data)
+    else:
+        header, chaninfos = read_header(data)
+        offsets, types, end = index_packets(data, chaninfos = chaninfos,
+                                                  skipped = skipped)
+    if attitude is not None:
+        attitude.add_columns(ping_columns(data, offsets[types == 3],
+                                          attitude.fields, ATTITUDE_FIELDS))
+    offsets = offsets[types == 0]
+    columns = ping_columns(data, offsets, fields)
+    columns['offset'] = offsets
+    return columns
+
+TIME_FIELDS = ['year', 'month', 'day', 'hour', 'minute', 'second', 'hseconds']
+
+def ping_timestamps(columns):
+    """Seconds since 1970-01-01 from TIME_FIELDS columns"""
+    y, m, d = [columns[f].astype(np.int64) for f in 'year', 'month', 'day']
+
+    # days_from_civil() from http://howardhinnant.github.io/date_algorithms.html
+    y = y - (m <= 2)
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * (m + np.where(m > 2, -3, 9)) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    days = era * 146097 + doe - 719468
+
+    return (days * 86400.0 + columns['hour'] * 3600.0 +
+            columns['minute'] * 60.0 + columns['second'] +
+            columns['hseconds'] / 100.0)
+
+# attitude fields kept by AttitudeSeries, angles in degrees
+ATTITUDE_COLUMNS = ['pitch', 'roll', 'heave', 'yaw', 'heading']
+ANGLE_COLUMNS = ['yaw', 'heading'] # interpolated across 360 -> 0
+
+def attitude_timestamps(columns):
+    """Seconds since 1970-01-01 of attitude packet columns"""
+    columns = dict(columns, hseconds = 0)
+    return ping_timestamps(columns) + columns['milliseconds'] / 1000.0
+
+class AttitudeSeries(object):
+    """Attitude packets as time series columns, for interpolation to pings
+
+    Records are added while packets are read (add), so that motion at
+    pings is known in the same pass. Processing operators using the
+    series (e.g. processing.Heave) share it between channel copies.
+
+    >>> a = AttitudeSeries()
+    >>> a.add_columns(dict(year = np.array([2012, 2012]), month = [5, 5],
+    ...     day = [17, 17], hour = [10, 10], minute = [0, 0], second = [0, 1],
+    ...     milliseconds = np.array([0, 0]), pitch = [0.0, 1.0],
+    ...     roll = [0.0, 0.0], heave = [0.2, 0.4], yaw = [350.0, 10.0],
+    ...     heading = [350.0, 10.0]))
+    >>> t = a.columns()['time'][0] + np.array([0.5, 2.0])
+    >>> i = a.interpolate(t, ['heave', 'yaw'])
+    >>> i['heave'].round(3).tolist(), i['yaw'].round(3).tolist()
+    ([0.3, 0.4], [0.0, 10.0])
+    """
+
+    fields = ATTITUDE_COLUMNS + ['year', 'month', 'day', 'hour', 'minute',
+                                 'second', 'milliseconds']
+
+    def __init__(self):
+        self.rows = [] # headers of attitude packets not in arrays yet
+        self.size = 0 # number of records in arrays
+        # sorted by time, with spare capacity for appending
+        self.arrays = dict((name, np.zeros(0))
+                           for name in ATTITUDE_COLUMNS + ['time'])
+
+    def add(self, packets):
+        """Add attitude packets (other packets are ignored)"""
+        for p in packets:
+            if isinstance(p, AttitudePacket):
+                self.rows.append(p.aheader)
+
+    def add_columns(self, columns):
+        """Add records from `fields` columns"""
+        columns = dict((name, np.asarray(columns[name])) for name in self.fields)
+        values = dict((name, columns[name].astype(np.float64))
+                      for name in ATTITUDE_COLUMNS)
+        values['time'] = attitude_timestamps(columns)
+        self._append(values)
+
+    def _append(self, values):
+        order = np.argsort(values['time'], kind = 'mergesort')
+        values = dict((name, a[order]) for name, a in values.items())
+        n, k = self.size, len(order)
+        if not k:
+            return
+        if n and values['time'][0] < self.arrays['time'][n - 1]:
+            # records out of order (rare): merge them in
+            where = np.searchsorted(self.arrays['time'][:n], values['time'],
+                                    'right')
+            for name in self.arrays:
+                self.arrays[name] = np.insert(self.arrays[name][:n], where,
+                                              values[name])
+        else:
+            if n + k > len(self.arrays['time']):
+                capacity = max(2 * len(self.arrays['time']), n + k, 64)
+                for name, a in self.arrays.items():
+                    grown = np.zeros(capacity)
+                    grown[:n] = a[:n]
+                    self.arrays[name] = grown
+            for name in self.arrays:
+                self.arrays[name][n:n + k] = values[name]
+        self.size = n + k
+
+    def columns(self):
+        """{name: array} of ATTITUDE_COLUMNS and time, in order of time"""
+        if self.rows:
+            rows, self.rows = self.rows, []
+            self.add_columns(dict((name, [r[name] for r in rows])
+                                  for name in self.fields))
+        return dict((name, a[:self.size]) for name, a in self.arrays.items())
+
+    def end_time(self):
+        """Time of the latest record, None if there are none"""
+        time = self.columns()['time']
+        return time[-1] if len(time) else None
+
+    def __len__(self):
+        return len(self.columns()['time'])
+
+    def interpolate(self, times, names = ATTITUDE_COLUMNS):
+        """{name: array} of attitude at `times` (seconds since 1970)
+
+        Times outside the series get the first or last values, all zeros
+        if there are no records.
+        """
+        columns = self.columns()
+        if not len(columns['time']) or not len(times):
+            return dict((name, np.zeros(len(times))) for name in names)
+        # only records around `times` are used, so cost doesn't grow with
+        # the series
+        lo = max(columns['time'].searchsorted(np.min(times)) - 1, 0)
+        hi = columns['time'].searchsorted(np.max(times), 'right') + 1
+        time = columns['time'][lo:hi]
+        result = {}
+        for name in names:
+            values = columns[name][lo:hi]
+            if name in ANGLE_COLUMNS:
+                values = np.degrees(np.unwrap(np.radians(values)))
+                result[name] = np.interp(times, time, values) % 360
+            else:
+                result[name] = np.interp(times, time, values)
+        return result
+
+    def __deepcopy__(self, memo):
+        return self # shared, see class docstring
+
+def read_attitude(infile):
+    """AttitudeSeries of all attitude packets of XTF file"""
+    data = map_input(infile)
+    offsets, types, end = index_packets(data)
+    series = AttitudeSeries()
+    series.add_columns(ping_columns(data, offsets[types == 3], series.fields,
+                                    ATTITUDE_FIELDS))
+    return series
+
+class XTFReader(object):
+    """XTF file opened for random access to channels, see open_reader()
+
+    Packets are indexed once (see index_packets), then channels read only
+    pings that are asked for. Seeking is fast in uncompressed and .zblk
+    files, but slow in .gz and .xz ones.
+    """
+
+    def __init__(self, path, cache_blocks = 16, block_pings = 256):
+        self.path = path
+        self.cache_blocks = cache_blocks
+        self.block_pings = block_pings
+
+        data = map_input(path)
+        try:
+            self.header, self.chaninfos = read_header(data)
+            offsets, types, end = index_packets(data)
+            offsets = offsets[types == 0]
+            self.columns = ping_columns(data, offsets,
+                                        ['channel_number', 'num_samples',
+                                         'num_chans_to_follow', 'ping_number'])
+            self.columns['offset'] = offsets
+        finally:
+            if hasattr(data, 'close'):
+                data.close()
+
+        self._file = open_input(path)
+        self._lock = threading.Lock()
+        self._cache = OrderedDict() # (channel, block) -> array, LRU first
+
+    def channel(self, number):
+        """Lazy ChannelArray of channel `number` (counting from 0)"""
+        if not 0 <= number < len(self.chaninfos):
+            raise BadDataError('Channel %d not found in "%s"' %
+                                                    (number + 1, self.path))
+        return ChannelArray(self, number)
+
+    def _read(self, start, end):
+        with self._lock:
+            self._file.seek(start)
+            return self._file.read(end - start)
+
+    def _block(self, channel, i):
+        """Decoded block `i` of channel pings: (pings, samples) array"""
+        key = channel.number, i
+        with self._lock:
+            block = self._cache.pop(key, None)
+            if block is not None:
+                self._cache[key] = block # most recently used
+                return block
+
+        pings = slice(i * self.block_pings, (i + 1) * self.block_pings)
+        offsets = channel.offsets[pings]
+        num_samples = channel.num_samples[pings]
+        starts = offsets + 256 + 64 * channel.num_chans[pings]
+        ends = starts + num_samples * channel.dtype.itemsize
+        data = np.frombuffer(self._read(offsets[0], ends.max()), np.uint8)
+
+        block = np.zeros((len(offsets), channel.shape[1]), channel.dtype)
+        if len(offsets) and (num_samples == num_samples[0]).all():
+            # all pings of the same length: gather them at once
+            index = (starts - offsets[0])[:, np.newaxis] + \
+                    np.arange(num_samples[0] * channel.dtype.itemsize)
+            block[:, :num_samples[0]] = data[index].view(channel.dtype)
+        else:
+            for row, start, end in zip(block, starts - offsets[0],
+                                              ends - offsets[0]):
+                samples = data[start:end].view(channel.dtype)
+                row[:len(samples)] = samples
+
+        with self._lock:
+            self._cache[key] = block
+            while len(self._cache) > self.cache_blocks:
+                self._cache.popitem(last = False)
+        return block
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+def ping_index(key, n_pings):
+    """(ping indices array, samples index, single ping?) of array-like index
+
+    key - channel[key] index: ping integer or slice, optionally followed by
+          samples index
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+    if len(key) > 2:
+        raise IndexError('Too many indices')
+    pings = key[0]
+    samples = key[1] if len(key) > 1 else slice(None)
+    if isinstance(pings, slice):
+        return np.arange(*pings.indices(n_pings)), samples, False
+    i = pings + n_pings if pings < 0 else pings
+    if not 0 <= i < n_pings:
+        raise IndexError('Ping index %d out of range' % pings)
+    return np.array([i]), samples, True
+
+class ChannelArray(object):
+    """Array-like (pings, samples) view of XTF channel, read on indexing
+
+    Supports integer and slice (including step) indices for pings and
+    samples: channel[1000:2000:2, 0:512]. Shorter pings are padded with 0.
+    """
+
+    def __init__(self, reader, number):
+        self.reader = reader
+        self.number = number
+        mine = reader.columns['channel_number'] == number
+        self.offsets = reader.columns['offset'][mine]
+        self.num_samples = reader.columns['num_samples'][mine]
+        self.num_chans = reader.columns['num_chans_to_follow'][mine]
+        self.ping_numbers = reader.columns['ping_number'][mine]
+        bytes_per_sample = reader.chaninfos[number]['bytes_per_sample']
+        self.dtype = np.dtype({1: np.int8, 2: np.int16}[bytes_per_sample])
+        self.shape = (len(self.offsets),
+                      int(self.num_samples.max()) if len(self.offsets) else 0)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        indices, samples, single = ping_index(key, self.shape[0])
+        out = np.empty((len(indices), self.shape[1]), self.dtype)
+        block_pings = self.reader.block_pings
+        blocks = indices // block_pings
+        for b in np.unique(blocks):
+            rows = blocks == b
+            out[rows] = self.reader._block(self, b)[indices[rows] -
+                                                    b * block_pings]
+        out = out[:, samples]
+        return out[0] if single else out
+
+    def __array__(self, dtype = None):
+        a = self[:]
+        return a if dtype is None else a.astype(dtype)
+
+def open_reader(path, cache_blocks = 16):
+    """Open XTF file for lazy reading: open_reader(path).channel(0)[1000:2000]
+
+    cache_blocks - number of decoded ping blocks to keep in memory
+    """
+    return XTFReader(path, cache_blocks)
+
+Track = namedtuple('Track', 'times lons lats')
+METERS_PER_DEGREE = 111320.0 # of latitude, and of longitude on the equator
+
+def read_track(infile, skipped = None):
+    """Ship track of XTF file, one point per ping (not per channel packet)
+
+    Only time and coordinate fields are read, see read_ping_columns.
+    skipped - list to turn on recovery mode, see index_packets
 
-def grayscale_arrays_gen(packets, chaninfos):
+    File without pings (e.g. just created by a logger) gives empty track:
+    >>> header = dict((name, '' if format.endswith('s') else 0)
+    ...               for name, (offset, format) in offsets(HEADER).items())
+    >>> header['file_format'] = 0x7b
+    >>> write_XTF('/tmp/xtf_doctest.xtf', header, [], [])
+    >>> [len(a) for a in read_track('/tmp/xtf_doctest.xtf')]
+    [0, 0, 0]
+    """
+    columns = read_ping_columns(infile, TIME_FIELDS + ['ping_number',
+                                                       'ship_xcoordinate',
+                                                       'ship_ycoordinate'],
+                                skipped = skipped)
+    pings = columns['ping_number']
+    lons = columns['ship_xcoordinate']
+    lats = columns['ship_ycoordinate']
+    keep = np.ones(len(pings), dtype = bool)
+    keep[1:] = pings[1:] != pings[:-1]
+    keep &= (lons != 0) | (lats != 0) # no navigation
+    return Track(ping_timestamps(columns)[keep], lons[keep], lats[keep])
+
+def simplify_track(lons, lats, tolerance):
+    """Douglas-Peucker simplification, return indices of points to keep
+
+    tolerance - maximum deviation from the original track, meters
+    """
+    n = len(lons)
+    if n < 3:
+        return np.arange(n)
+    lat0 = np.radians(lats.mean())
+    x = (lons - lons.mean()) * np.cos(lat0) * METERS_PER_DEGREE
+    y = (lats - lats.mean()) * METERS_PER_DEGREE
+
+    keep = np.zeros(n, dtype = bool)
+    keep[[0, -1]] = True
+    ranges = [(0, n - 1)]
+    while ranges:
+        a, b = ranges.pop()
+        if b - a < 2:
+            continue
+        dx, dy = x[b] - x[a], y[b] - y[a]
+        px, py = x[a+1:b] - x[a], y[a+1:b] - y[a]
+        length = np.hypot(dx, dy)
+        if length > 0:
+            distances = np.abs(dx * py - dy * px) / length
+        else:
+            distances = np.hypot(px, py)
+        i = distances.argmax()
+        if distances[i] > tolerance:
+            keep[a + 1 + i] = True
+            ranges += [(a, a + 1 + i), (a + 1 + i, b)]
+    return np.flatnonzero(keep)
+
+def export_tracks(infiles, outfile, tolerance = 5.0):
+    """Write simplified ship tracks of XTF files to GeoJSON or CSV file
+
+    Output format depends on `outfile` extension: .csv or .json/.geojson.
+    tolerance - maximum deviation from the original tracks, meters
+    """
+    tracks = []
+    for infile in infiles:
+        track = read_track(infile)
+        keep = simplify_track(track.lons, track.lats, tolerance)
+        tracks.append((infile, Track(*[a[keep] for a in track])))
+
+    def iso(t):
+        return (datetime(1970, 1, 1) + timedelta(seconds = t)).isoformat()
+
+    with BackgroundWriter(outfile) as out:
+        if split_ext(outfile)[1].lower().startswith('.csv'):
+            writer = csv.writer(out, delimiter = ';')
+            writer.writerow(['File', 'Time', 'Longitude', 'Latitude'])
+            for infile, track in tracks:
+                for t, lon, lat in zip(*track):
+                    writer.writerow([infile, iso(t), repr(lon), repr(lat)])
+        else:
+            features = [dict(type = 'Feature',
+                             geometry = dict(type = 'LineString',
+                                             coordinates = zip(track.lons,
+                                                               track.lats)),
+                             properties = dict(file = infile,
+                                               start = iso(track.times[0]),
+                                               end = iso(track.times[-1])))
+                        for infile, track in tracks if len(track.times)]
+            out.write(json.dumps(dict(type = 'FeatureCollection',
+                                      features = features)))
+
+Marker = namedtuple('Marker', 'time ping_number offset kind text')
+
+class MarkerIndex(object):
+    """Picket markers of XTF file: notes packets and event number changes
+
+    markers - Marker tuples in file order:
+        time - seconds since 1970-01-01
+        ping_number - ping of the marker (for notes: the preceding ping)
+        offset - file offset of the packet, to seek to (see read_packets)
+        kind - 'note' or 'event'
+        text - note text or new event number
+    end - offset right after the last complete packet
+
+    Index is filled while packets are parsed, see `markers` option of
+    read_XTF, or at once by read_markers().
+    """
+
+    def __init__(self, markers = (), end = None):
+        self.markers = list(markers)
+        self.end = end
+        self._event = None # event number of the last ping
+        self._ping_number = None # the last ping
+        self._keys = {} # sorted keys for find(), made when needed
+
+    def __iter__(self):
+        return iter(self.markers)
+
+    def __len__(self):
+        return len(self.markers)
+
+    def _add(self, marker):
+        self.markers.append(marker)
+        self._keys.clear()
+
+    def add_ping(self, offset, sheader):
+        """Record sonar packet, add marker if event number has changed"""
+        if self._event is not None and sheader['event_number'] != self._event:
+            self._add(Marker(header_timestamp(sheader), sheader['ping_number'],
+                             offset, 'event', str(sheader['event_number'])))
+        self._event = sheader['event_number']
+        self._ping_number = sheader['ping_number']
+
+    def add_note(self, offset, nheader):
+        """Record notes packet"""
+        self._add(Marker(header_timestamp(nheader), self._ping_number, offset,
+                         'note', nheader['notes_text'].rstrip('\0')))
+
+    def _sorted(self, name):
+        """(sorted keys, marker indices) of markers by time or ping_number"""
+        if name not in self._keys:
+            if name == 'time':
+                keys = [m.time for m in self.markers]
+            else:
+                keys = [-1 if m.ping_number is None else m.ping_number
+                        for m in self.markers]
+            # stable: of equal keys, the last in file order is found
+            order = sorted(range(len(keys)), key = keys.__getitem__)
+            self._keys[name] = [keys[i] for i in order], order
+        return self._keys[name]
+
+    def find(self, time = None, ping_number = None):
+        """The last marker at or before `time` or `ping_number`, or None"""
+        if time is not None:
+            keys, order = self._sorted('time')
+            i = bisect_right(keys, time)
+        else:
+            keys, order = self._sorted('ping_number')
+            i = bisect_right(keys, ping_number)
+        if i > 0:
+            return self.markers[order[i - 1]]
+
+    def ranges(self):
+        """(marker, start, end) offsets of file parts between markers"""
+        ends = [m.offset for m in self.markers[1:]] + [self.end]
+        return [(m, m.offset, end) for m, end in zip(self.markers, ends)]
+
+def header_timestamp(header):
+    """Seconds since 1970-01-01 of sonar or notes header (no hseconds)"""
+    return float(ping_timestamps(dict((name, np.array([header.get(name, 0)]))
+                                      for name in TIME_FIELDS))[0])
+
+def read_markers(infile):
+    """MarkerIndex of XTF file, only notes packets are kept after parsing"""
+    markers = MarkerIndex()
+    header, chaninfos, packets = read_XTF(infile, 'notes', markers = markers)
+    for p in packets:
+        pass
+    return markers
+
+def read_packets(infile, chaninfos, start, end, packet_filter = '*'):
+    """Parse only packets between file offsets `start` and `end`"""
+    with open_input(infile) as f:
+        f.seek(start)
+        data = memoryview(f.read(end - start))
+    return packets_gen(data, chaninfos, packet_filter)
+
+BISECT_MIN = 2**16 # bytes left for linear scan after bisection
+
+def packet_timestamp(data, offset):
+    """Ping time of sonar packet at `offset`, seconds since 1970-01-01"""
+    return ping_timestamps(dict((name, np.array([field(data, offset, name)]))
+                                for name in TIME_FIELDS))[0]
+
+def next_sonar_packet(data, offset, chaninfos = None):
+    """Offset of the first sonar packet at or after `offset` (may be
+    in the middle of a packet), or None"""
+    offset = find_packet(data, offset, chaninfos)
+    while offset + PACKET_HEADER_LEN <= len(data):
+        if field(data, offset, 'header_type') == 0:
+            return offset
+        offset = find_packet(data, offset + max(PACKET_HEADER_LEN,
+                        field(data, offset, 'num_bytes_this_record')), chaninfos)
+
+def bisect_pings(data, key, target, chaninfos = None):
+    """Offset of the first sonar packet with key(data, offset) > target
+
+    Pings must be in order of `key`. Only O(log(n)) packets are looked at
+    before a short linear scan, so on memory-mapped files the cost doesn't
+    depend on file size. Return offset after the last packet if none.
+    """
+    lo, hi = HEADER_LEN, len(data)
+    # all sonar packets before `lo` are <= target, those at `hi` and after
+    # are > target
+    while hi - lo > BISECT_MIN:
+        mid = (lo + hi) // 2
+        offset = next_sonar_packet(data, mid, chaninfos)
+        if offset is None or offset >= hi or key(data, offset) > target:
+            hi = mid
+        else:
+            lo = offset + 1
+    offset = next_sonar_packet(data, lo, chaninfos)
+    while offset is not None and offset < hi:
+        if key(data, offset) > target:
+            return offset
+        offset = next_sonar_packet(data, offset + 1, chaninfos)
+    if hi < len(data):
+        return find_packet(data, hi, chaninfos)
+    return index_packets(data, find_packet(data, lo, chaninfos))[2]
+
+def ping_number_key(data, offset):
+    return field(data, offset, 'ping_number')
+
+def epoch_seconds(t):
+    return (t - datetime(1970, 1, 1)).total_seconds()
+
+def find_range(data, start_time = None, end_time = None,
+                     first_ping = None, last_ping = None, chaninfos = None):
+    """(start, end) offsets of packets in time window or ping number range
+
+    Times are datetime objects, ranges include both ends.
+    """
+    start = find_packet(data, HEADER_LEN, chaninfos)
+    end = bisect_pings(data, ping_number_key, float('inf'), chaninfos)
+    if start_time is not None:
+        # the first ping with time >= start_time
+        start = max(start, bisect_pings(data, packet_timestamp,
+                                        epoch_seconds(start_time) - 0.001,
+                                        chaninfos))
+    if first_ping is not None:
+        start = max(start, bisect_pings(data, ping_number_key,
+                                        first_ping - 1, chaninfos))
+    if end_time is not None:
+        end = min(end, bisect_pings(data, packet_timestamp,
+                                    epoch_seconds(end_time), chaninfos))
+    if last_ping is not None:
+        end = min(end, bisect_pings(data, ping_number_key, last_ping,
+                                    chaninfos))
+    return start, max(start, end)
+
+def extract_XTF(infile, outfile, sync = False, **window):
+    """Copy packets in time window or ping range to new XTF file, as is
+
+    window - find_range arguments (start_time, end_time, first_ping,
+             last_ping). Uncompressed files are memory-mapped, so only
+             the window and a few packets found by bisection are read.
+    """
+    data = map_input(infile)
+    header, chaninfos = read_header(data)
+    start, end = find_range(data, chaninfos = chaninfos, **window)
+    with BackgroundWriter(outfile, sync = sync) as out:
+        out.write(data[:HEADER_LEN])
+        for offset in range(start, end, CHUNK_SIZE):
+            out.write(data[offset:min(offset + CHUNK_SIZE, end)])
+    return end - start
+
+def extract_SEGY(infile, outfile, channel_numbers, to_utm = True,
+                 utm_params = None, sync = False, window = None, **options):
+    """Convert packets in time window or ping range to SEG-Y
+
+    window - find_range arguments, see extract_XTF
+    options - SEGYChannelWriter options
+    """
+    data = map_input(infile)
+    header, chaninfos = read_header(data)
+    start, end = find_range(data, chaninfos = chaninfos, **(window or {}))
+    packets = packets_gen(memoryview(data[start:end]), chaninfos, 'sonar')
+    write_SEGY_channels(infile, outfile, header, chaninfos, packets,
+                        channel_numbers, to_utm, utm_params, sync, **options)
+
+def first_ping_time(infile):
+    """Time of the first sonar packet in XTF file (None if there are none)"""
+    with open_input(infile) as f:
+        for offset, pheader in scan_packets(f):
+            if header_type(pheader) == 'sonar':
+                sheader_len, sheader = unwrap(f.read(256 - PACKET_HEADER_LEN),
+                                              SONAR_HEADER, 'XTFPINGHEADER')
+                return ping_datetime(sheader)
+
+class XTFFollower(object):
+    """Parse packets of XTF file while it's still being written
+
+    Each poll() parses only packets completed since the previous call: the
+    offset of the first unparsed packet is kept between calls. Incomplete
+    trailing packet is left for the next poll().
+
+    Usage:
+        follower = XTFFollower(infile, 'sonar')
+        builder = GrayscaleBuilder(follower.chaninfos)
+        while True:
+            builder.add(follower.poll())
+            ...
+    """
+
+    def __init__(self, infile, packet_filter = '*'):
+        self.infile = infile
+        self.packet_filter = packet_filter
+        self.offset = HEADER_LEN
+        self.header = None
+        self.chaninfos = None
+        self._file = open(infile, 'rb')
+        self._read_header()
+
+    def _read_header(self):
+        self._file.seek(0)
+        data = self._file.read(HEADER_LEN)
+        if len(data) < HEADER_LEN:
+            return # not written yet
+        data = memoryview(data)
+        header_len, header = unwrap(data, HEADER, data_factory = OrderedDict)
+        nchannels = (header['number_of_sonar_channels'] +
+                     header['number_of_bathymetry_channels'])
+        self.chaninfos = [unwrap(data[header_len+i*CHANINFO_LEN:], CHANINFO)[1]
+                          for i in range(nchannels)]
+        self.header = header
+
+    def poll(self):
+        """Parse new complete packets, return them as list"""
+        if self.header is None:
+            self._read_header()
+            if self.header is None:
+                return []
+
+        self._file.seek(self.offset)
+        data = self._file.read()
+
+        # end of the last complete packet
+        offsets, types, end = index_packets(data, 0)
+        packets = list(packets_gen(memoryview(data)[:end], self.chaninfos,
+                                   self.packet_filter))
+        self.offset += end
+        return packets
+
+    def close(self):
+        self._file.close()
+
+def follow_XTF(infile, packet_filter = '*', poll_interval = 1.0,
+                                            idle_timeout = None):
+    """Iterate over packets of XTF file, waiting for new ones at the end
+
+    Stops when file doesn't grow for `idle_timeout` seconds (never if None).
+    """
+    follower = XTFFollower(infile, packet_filter)
+    try:
+        idle_since = time.time()
+        while True:
+            packets = follower.poll()
+            for p in packets:
+                yield p
+            if packets:
+                idle_since = time.time()
+            elif (idle_timeout is not None and
+                    time.time() - idle_since > idle_timeout):
+                return
+            else:
+                time.sleep(poll_interval)
+    finally:
+        follower.close()
+
+def read_XTF_as_grayscale_arrays(infile, process = None, attitude = None):
+    header, chaninfos, packets = read_XTF(infile, 'sonar' if attitude is None
+                                                  else '*')
+    return header, len(chaninfos), grayscale_arrays_gen(packets, chaninfos,
+                                                        process, attitude)
+
+def grayscale_arrays_gen(packets, chaninfos, process = None,
+                                              attitude = None):
     """Iterator over channel info tuples: (number, type, trace_headers, data)
 
     data - grayscale numpy array (n_traces by trace_len)
+    process - processing operator, see processing.py
+    attitude - AttitudeSeries to add attitude packets to, see GrayscaleBuilder
     """
 
-    packets = sorted(packets, key=lambda p: p.channel_number)
+    builder = GrayscaleBuilder(chaninfos, process, attitude)
+    builder.add(packets)
+    for channel in builder.arrays():
+        yield channel
+
+# sonar packet fields passed to processing operators, together with ping
+# 'time' (seconds since 1970, see ping_timestamps)
+PROCESS_FIELDS = ['ping_number', 'time_delay', 'time_duration', 'num_samples',
+                  'slant_range', 'sensor_primary_altitude', 'sensor_depth',
+                  'heave'] + TIME_FIELDS
+
+def packet_columns(packets, fields = PROCESS_FIELDS):
+    """Fields of parsed sonar packets as {name: array} columns"""
+    columns = {}
+    for name in fields:
+        offset, format = PING_FIELDS[name]
+        part = ('pheader' if offset < PACKET_HEADER_LEN else
+                'sheader' if offset < 256 else 'cheader')
+        columns[name] = np.array([getattr(p, part)[name] for p in packets],
+                                 dtype = DTYPES.get(format))
+    return columns
+
+def process_traces(process, packets):
+    """Apply processing operator to traces of sonar packets"""
+    traces = np.vstack([p.trace for p in packets]).astype(np.float32)
+    columns = packet_columns(packets)
+    columns['time'] = ping_timestamps(columns)
+    return process(traces, columns)
+
+class GrayscaleBuilder(object):
+    """Collect sonar packets into channel arrays, bit by bit
+
+    Useful together with XTFFollower: add() new packets after each poll(),
+    then call arrays() to get updated channels.
+
+    process - processing operator, applied to blocks of BLOCK_PINGS pings
+              (each channel gets its own copy)
+    attitude - AttitudeSeries, attitude packets are added to it before
+               pings are processed (for operators using it), see block_ready
+    """
 
-    for num, packets in groupby(packets, lambda p: p.channel_number):
-        packets = list(packets)
-        headers = [p.trace_header() for p in packets]
-        traces = [p.trace for p in packets]
-        type = CHAN_TYPES[chaninfos[num]['type_of_channel']]
+    def __init__(self, chaninfos, process = None, attitude = None):
+        self.chaninfos = chaninfos
+        self.process = process
+        self.attitude = attitude
+        self.processes = {}
+        self.headers = {}
+        self.traces = {} # traces, or processed blocks of them
+        self.pending = {} # packets waiting for processing
 
-        r = np.vstack(traces).transpose()
-        yield num, type, headers, r
+    def add(self, packets):
+        for p in packets:
+            if self.attitude is not None and isinstance(p, AttitudePacket):
+                self.attitude.add([p])
+            elif hasattr(p, 'sheader'): # sonar packet
+                num = p.channel_number
+                self.headers.setdefault(num, []).append(p.trace_header())
+                if self.process is None:
+                    self.traces.setdefault(num, []).append(p.trace)
+                else:
+                    pending = self.pending.setdefault(num, [])
+                    pending.append(p)
+                    while block_ready(self.pending[num], BLOCK_PINGS,
+                                      self.attitude):
+                        self._process(num, BLOCK_PINGS)
+
+    def _process(self, num, count = None):
+        """Process `count` (all by default) pending packets of channel"""
+        packets = self.pending[num][:count]
+        self.pending[num] = self.pending[num][len(packets):]
+        if packets:
+            if num not in self.processes:
+                self.processes[num] = copy.deepcopy(self.process)
+            self.traces.setdefault(num, []).append(
+                                process_traces(self.processes[num], packets))
+
+    def arrays(self):
+        """Iterator over channel info tuples, see grayscale_arrays_gen"""
+        for num in self.pending:
+            self._process(num)
+        for num in sorted(self.traces):
+            type = CHAN_TYPES[self.chaninfos[num]['type_of_channel']]
+            r = np.vstack(self.traces[num]).transpose()
+            yield num, type, self.headers[num], r
+
+WINDOW_FIELDS = ['ping_number', 'time_delay', 'time_duration', 'num_samples',
+                 'sensor_primary_altitude']
+
+class SampleWindow(object):
+    """Window of samples kept on export, to drop water column and noise
+
+    start, end - two-way time (s) of the window from transmit, or from the
+                 seabed if `follow` is given (e.g. -0.005, 0.05)
+    follow - None for fixed window, 'altitude' for the seabed at
+             sensor_primary_altitude or {ping number: seabed two-way time}
+             of bottom picks
+    sound_velocity - m/s, for converting altitude to time
+
+    Pings without altitude (zero) or pick get the seabed interpolated from
+    other pings in the same block, or fixed window if there are none.
+    Window starts are rounded down to whole milliseconds, as SEG-Y
+    delay_recording_time is in ms. All pings get the same number of
+    samples, those outside of the recorded trace are zeros.
+    """
 
-def export_XTF(infile, outfile, channel_numbers):
-    header, chaninfos, packets = read_XTF(infile, '*')
+    def __init__(self, start, end, follow = None, sound_velocity = 1500.0):
+        if end <= start:
+            raise ValueError('Empty sample window %r - %r' % (start, end))
+        self.start = start
+        self.end = end
+        self.follow = follow
+        self.sound_velocity = sound_velocity
+
+    def n_samples(self, sample_interval):
+        return max(1, int(round((self.end - self.start) / sample_interval)))
+
+    def seabed(self, columns):
+        """Seabed two-way time (s) of pings, NaN where unknown"""
+        if self.follow == 'altitude':
+            altitude = columns['sensor_primary_altitude'].astype(np.float64)
+            return np.where(altitude > 0,
+                            2 * altitude / self.sound_velocity, np.nan)
+        return np.array([self.follow.get(n, np.nan)
+                         for n in columns['ping_number']], dtype = np.float64)
+
+    def starts(self, columns):
+        """Window start time (s) of every ping, before rounding"""
+        n = len(columns['ping_number'])
+        if self.follow is None:
+            return np.repeat(float(self.start), n)
+        seabed = self.seabed(columns)
+        known = np.isfinite(seabed)
+        if not known.any():
+            return np.repeat(float(self.start), n)
+        i = np.arange(n)
+        return self.start + np.interp(i, i[known], seabed[known])
+
+    def crop(self, traces, columns):
+        """(cropped traces, time (s) of their first samples) of a block"""
+        dt = (columns['time_duration'].astype(np.float64) /
+              columns['num_samples'])
+        n = self.n_samples(dt[0])
+        starts = np.floor(self.starts(columns) * 1000) / 1000.0
+        first = np.round((starts - columns['time_delay']) / dt).astype(np.int64)
+        index = first[:, np.newaxis] + np.arange(n)
+        inside = (index >= 0) & (index < traces.shape[1])
+        cropped = np.zeros((len(traces), n), traces.dtype)
+        rows = np.nonzero(inside)[0]
+        cropped[inside] = traces[rows, index[inside]]
+        return cropped, columns['time_delay'] + first * dt
+
+def crop_packets(packets, window):
+    """Crop traces of sonar packets to SampleWindow, in blocks of BLOCK_PINGS
+    packets. Other packets are passed as they are.
+    """
+    block = []
+    for p in packets:
+        block.append(p)
+        if len(block) >= BLOCK_PINGS:
+            for p in _crop_block(block, window):
+                yield p
+            block = []
+    for p in _crop_block(block, window):
+        yield p
+
+def _crop_block(packets, window):
+    groups = {}
+    for i, p in enumerate(packets):
+        if hasattr(p, 'sheader'):
+            groups.setdefault((p.channel_number, len(p.trace)), []).append(i)
+    packets = list(packets)
+    for indices in groups.values():
+        sonar = [packets[i] for i in indices]
+        traces, times = window.crop(np.vstack([p.trace for p in sonar]),
+                                    packet_columns(sonar, WINDOW_FIELDS))
+        for i, p, trace, t in zip(indices, sonar, traces, times):
+            cheader = p.cheader.copy()
+            cheader['time_delay'] = t
+            cheader['time_duration'] = (p.cheader['time_duration'] *
+                                        len(trace) / p.cheader['num_samples'])
+            cheader['num_samples'] = len(trace)
+            raw_trace = trace.tostring()
+            pheader = p.pheader.copy()
+            pheader['num_bytes_this_record'] += (len(raw_trace) -
+                                                 len(p.raw_trace))
+            packets[i] = p._replace(pheader = pheader, cheader = cheader,
+                                    trace = trace, raw_trace = raw_trace)
+    return packets
+
+def export_XTF(infile, outfile, channel_numbers, skipped = None,
+                                                 window = None):
+    """Copy channels of XTF file to new XTF file
+
+    window - SampleWindow to crop sonar traces to
+    """
+    header, chaninfos, packets = read_XTF(infile, '*', skipped)
 
     channel_numbers = sorted(set(channel_numbers))
     chaninfos = [chaninfos[ch] for ch, info in enumerate(chaninfos)
@@ -397,134 +1266,487 @@ def export_XTF(infile, outfile, channel_numbers):
             else:
                 yield p
 
-    write_XTF(outfile, header, chaninfos, packets_gen())
+    selected = packets_gen()
+    if window is not None:
+        selected = crop_packets(selected, window)
+    write_XTF(outfile, header, chaninfos, selected)
 
-def export_SEGY(infile, outfile, (channel_number,), to_utm = True,
-                                                    utm_params = None):
-    header, chaninfos, packets = read_XTF(infile, 'sonar')
-    try:
-        chaninfo = chaninfos[channel_number]
-    except IndexError:
-        raise BadDataError('Channel %d not found in "%s"' %
-                                            (channel_number + 1, infile))
+def split_XTF(infile, outfile, max_bytes = None, max_pings = None,
+                               interval = None, sync = False):
+    """Split XTF file into pieces, without reading it into memory at once
 
-    packets = (p for p in packets if p.channel_number == channel_number)
+    Each piece gets a copy of the file header (with CHANINFO) and a range of
+    packets, copied as is. New piece is started at ping boundary, when:
 
-    # peek first packet, and keep generator intact
-    try:
-        p0 = packets.next()
-    except StopIteration:
-        raise BadDataError('Channel %d not found inside "%s"' %
-                                            (channel_number + 1, infile))
-
-    packets = chain([p0], packets)
-
-    sample_interval = int(round(p0.cheader['time_duration'] /
-                                p0.cheader['num_samples'] * 10**6))
-    sample_format = {1: 'b', 2: 'h'}[ chaninfo['bytes_per_sample'] ]
-
-    segy_header = dict(
-        n_traces_per_ensemble = 1,
-        n_auxtraces_per_ensemble = 0,
-        sample_interval = sample_interval,
-        n_trace_samples = p0.cheader['num_samples'],
-        sample_format = segy.SAMPLE_FORMATS[sample_format],
-        segy_rev = 0x0100,
-        fixed_length_trace_flag = 1,
-        n_extended_headers = 0,
-        measurement_system = 1, # meters
-        ensemble_fold = 1, # that's what Chesapeake XTF-To-SEGY is doing
-    )
+    max_bytes - current piece has reached this size
+    max_pings - current piece has this number of pings
+    interval - ping time crossed wall-clock boundary, e.g. 3600 for hourly
+               pieces starting at hh:00:00
 
+    Pieces are named <outfile base>_001.<ext>, ... Return list of names.
+    """
+    base, ext = split_ext(outfile)
+    outfiles = []
+    out = None
+    epoch = datetime(1970, 1, 1)
+    try:
+        with open_input(infile) as f:
+            file_header = f.read(HEADER_LEN)
+            unwrap(file_header, HEADER) # check file_format
+            if len(file_header) < HEADER_LEN:
+                raise BadDataError('Truncated file header in "%s"' % infile)
+
+            ping = None
+            for offset, pheader, packet in read_packets_forward(f):
+                n = pheader['num_bytes_this_record']
+                if len(packet) < n:
+                    sys.stdout.write('Truncated packet at %d, skipped\n' %
+                                                                       offset)
+                    break
+
+                new_ping = False
+                if header_type(pheader) == 'sonar':
+                    sheader_len, sheader = unwrap(
+                                    buffer(packet, PACKET_HEADER_LEN),
+                                    SONAR_HEADER, 'XTFPINGHEADER')
+                    new_ping = sheader['ping_number'] != ping
+                    ping = sheader['ping_number']
+                    if interval:
+                        t = ping_datetime(sheader) - epoch
+                        period = int(t.total_seconds() // interval)
+
+                if out is None or new_ping and (
+                        max_bytes and out_bytes >= max_bytes or
+                        max_pings and out_pings >= max_pings or
+                        interval and out_period not in (None, period)):
+                    if out is not None:
+                        out.close()
+                    outfiles.append('%s_%03d%s' % (base, len(outfiles) + 1,
+                                                   ext))
+                    out = BackgroundWriter(outfiles[-1], sync = sync)
+                    out.write(file_header)
+                    out_bytes = HEADER_LEN
+                    out_pings = 0
+                    out_period = None
+
+                if interval and new_ping:
+                    out_period = period
+                out.write(packet)
+                out_bytes += n
+                out_pings += new_ping
+        if out is not None:
+            out.close()
+    except:
+        if out is not None:
+            out.abort()
+        raise
+    return outfiles
+
+def detect_utm_zone(lon, lat):
+    """Detect UTM parameters (zone, hemisphere) from point coordinates"""
+    zone = int((lon + 180.0) % 360.0 / 6) + 1
+    hemisphere = 'S' if lat < 0.0 else 'N'
+    return zone, hemisphere
+
+def utm_converter(zone, hemisphere):
+    """pyproj converter (lon, lat) -> (x, y) of UTM zone, WGS84"""
+    from pyproj import Proj
+    return Proj(proj = 'utm', zone = zone, south = hemisphere == 'S',
+                                           ellps = 'WGS84')
+
+SEGYCoordinates = namedtuple('SEGYCoordinates',
+                             'units scaler converter description')
+
+def segy_coordinates(p0, to_utm = True, utm_params = None):
+    """Choose SEG-Y coordinate units and converter, p0 - first sonar packet"""
     if to_utm:
-        def detect():
-            """Detect UTM parameters from first point coordinates"""
-            lon = p0.sheader['ship_xcoordinate']
-            lat = p0.sheader['ship_ycoordinate']
-            zone = int((lon + 180.0) % 360.0 / 6) + 1
-            hemisphere = 'S' if lat < 0.0 else 'N'
+        if utm_params:
+            zone, hemisphere = utm_params
+        else:
+            zone, hemisphere = detect_utm_zone(p0.sheader['ship_xcoordinate'],
+                                               p0.sheader['ship_ycoordinate'])
             sys.stdout.write('Detected UTM zone: %d%s\n' % (zone, hemisphere))
-            return zone, hemisphere
-
-        zone, hemisphere = utm_params or detect()
         print 'zone=%r, hemi=%r' % (zone, hemisphere)
 
-        from pyproj import Proj
-        units = 1 # length
-        scaler = 1
-        converter = Proj(proj = 'utm', zone = zone, south = hemisphere == 'S',
-                                                    ellps = 'WGS84')
+        return SEGYCoordinates(units = 1, # length
+                               scaler = 1,
+                               converter = utm_converter(zone, hemisphere),
+                               description = 'UTM %d%s, m' % (zone, hemisphere))
     else:
         def d2s(deg, scale):
             """Convert degrees to (scaled) seconds of arc"""
             return deg * 60 * 60 * scale
 
-        units = 2 # secs of arc
-        scaler = -100
-        converter = lambda lon, lat: (d2s(lon, 100), d2s(lat, 100))
-
-    def traces():
-        for i, p in enumerate(packets):
-
-            # make sure we don't have variable trace len or sample interval
-            assert p.cheader['num_samples'] == p0.cheader['num_samples']
-            assert p.cheader['time_duration'] == p0.cheader['time_duration']
-
-            # Using sensor_[xy]coordinate seems to be more appropriate here,
-            # but in practice it's not. Chesapeake XTF-To-SEGY converter
-            # is also using ship_[xy]coordinate.
-            x, y = converter(p.sheader['ship_xcoordinate'],
-                             p.sheader['ship_ycoordinate'])
-
-            trace_header = dict(
-                trace_seq_in_line = i + 1,
-                trace_seq_in_file = i + 1,
-
-                # not suitable for trace_seq_in_*, counts 1 3 5 7...
-                trace_num_in_orig_record = p.sheader['ping_number'],
-
-                trace_id_code = 1, # seismic
+        return SEGYCoordinates(units = 2, # secs of arc
+                               scaler = -100,
+                               converter = lambda lon, lat: (d2s(lon, 100),
+                                                             d2s(lat, 100)),
+                               description = 'geographic')
 
-                year = p.sheader['year'],
-                day_of_year = p.sheader['julian_day'],
-                hour = p.sheader['hour'],
-                minute = p.sheader['minute'],
-                second = p.sheader['second'],
+BLOCK_PINGS = 256 # number of pings SEGYChannelWriter processes at once
+HOLD_PINGS = 8 * BLOCK_PINGS # at most this many pings wait for attitude
 
-                time_basis_code = 4,
-                n_samples = p.cheader['num_samples'],
-                sample_interval = sample_interval,
-                elevations_scaler = 1,
+def block_ready(pending, block_pings, attitude = None):
+    """True if the first `block_pings` pending sonar packets can be processed
 
-                coordinate_units = units,
-                coordinates_scaler = scaler,
-                reciever_coord_x = int(round(x)),
-                reciever_coord_y = int(round(y)),
-
-                #ensemble_num = ... # For marks when importing to Geographix
-            )
-            yield trace_header, p.trace
+    With AttitudeSeries, a block waits until attitude after its last ping
+    has been read, so its pings are interpolated, not clamped to the last
+    record. Unless HOLD_PINGS pings are waiting already (no attitude
+    in the rest of the file).
+    """
+    if len(pending) < block_pings:
+        return False
+    if attitude is None or len(pending) >= HOLD_PINGS:
+        return True
+    end_time = attitude.end_time()
+    return (end_time is not None and
+            end_time > header_timestamp(pending[block_pings - 1].sheader))
+
+def decimate_pings(traces, factor, stack = False):
+    """Keep every `factor`-th trace (row) or average groups of `factor` traces
+
+    >>> decimate_pings(np.arange(10).reshape(5, 2), 2, stack = True).tolist()
+    [[1.0, 2.0], [5.0, 6.0], [8.0, 9.0]]
+    """
+    if not stack:
+        return traces[::factor]
+    n = len(traces) // factor * factor
+    stacked = traces[:n].reshape(-1, factor, traces.shape[1]).mean(axis = 1)
+    if n < len(traces):
+        stacked = np.vstack([stacked, traces[n:].mean(axis = 0)])
+    return stacked
+
+def lowpass_taps(factor, width = 8):
+    """Windowed-sinc low-pass filter for downsampling by `factor`"""
+    n = np.arange(-width * factor, width * factor + 1)
+    h = np.sinc(n / float(factor)) * np.hamming(len(n))
+    return h / h.sum()
+
+def resample_samples(traces, factor):
+    """Downsample traces (rows) by integer `factor`, with anti-alias filter"""
+    h = lowpass_taps(factor)
+    half = len(h) // 2
+    n = traces.shape[1]
+    padded = np.zeros((len(traces), n + 2 * half))
+    padded[:, half:half + n] = traces
+    resampled = np.zeros((len(traces), len(range(0, n, factor))))
+    for k, c in enumerate(h): # only output samples are computed
+        resampled += c * padded[:, k:k + n:factor]
+    return resampled
+
+class SEGYChannelWriter(object):
+    """Convert sonar packets of one XTF channel to SEG-Y file traces
+
+    Every writer has its own SEG-Y headers and trace counters, so that
+    packets of several channels can be routed to several writers in one pass.
+    Packets are processed in blocks of BLOCK_PINGS pings:
+
+    decimate - keep every `decimate`-th ping
+    stack - average groups of `decimate` pings instead of skipping them
+    resample - keep every `resample`-th sample, after anti-alias filtering
+    sample_format - output segy.SAMPLE_FORMATS key, e.g. 'ibm' or 'f'
+                    (default: 'b' or 'h', samples are written as is)
+    process - processing operator applied before decimation (copied, so
+              that every writer has its own state), see processing.py
+    window - SampleWindow, traces are cropped after processing and
+             delay_recording_time is set to the window start
+    attitude - AttitudeSeries filled while packets are read, blocks wait
+               for it, see block_ready
+    """
 
-    text_header = Template("""Converted $filename to SEG-Y
+    def __init__(self, outfile, infile, header, chaninfo, p0, coordinates,
+                       sync = False, decimate = 1, stack = False,
+                                     resample = 1, sample_format = None,
+                                     process = None, window = None,
+                                     attitude = None):
+        self.p0 = p0
+        self.window = window
+        self.attitude = attitude
+        self.process = copy.deepcopy(process)
+        self.coordinates = coordinates
+        self.n_traces = 0
+        self.pending = []
+        self.decimate = decimate
+        self.stack = stack
+        self.resample = resample
+        self.block_pings = -(-BLOCK_PINGS // decimate) * decimate
+        dt = p0.cheader['time_duration'] / p0.cheader['num_samples']
+        n_samples = (window.n_samples(dt) if window is not None else
+                     p0.cheader['num_samples'])
+        self.n_samples = len(range(0, n_samples, resample))
+        self.sample_interval = int(round(dt * resample * 10**6))
+        self.bytes_per_sample = chaninfo['bytes_per_sample']
+        self.sample_format = (sample_format or
+                              {1: 'b', 2: 'h'}[ self.bytes_per_sample ])
+
+        segy_header = dict(
+            n_traces_per_ensemble = 1,
+            n_auxtraces_per_ensemble = 0,
+            sample_interval = self.sample_interval,
+            n_trace_samples = self.n_samples,
+            sample_format = segy.SAMPLE_FORMATS[self.sample_format],
+            segy_rev = 0x0100,
+            fixed_length_trace_flag = 1,
+            n_extended_headers = 0,
+            measurement_system = 1, # meters
+            ensemble_fold = 1, # that's what Chesapeake XTF-To-SEGY is doing
+        )
+
+        text_header = Template("""Converted $filename to SEG-Y
 XTF Surveyor v$version, $url
 Converted by: $user
 Converted at: $datetime
 Coordinates: $coord
+XTF channel: $channel
 XTF recording program: $program
 XTF this file name: $this_filename
 XTF note string: $note""").substitute(
-    filename = infile,
-    version =  version.__version__,
-    url = version.url,
-    user = getuser(),
-    datetime = datetime.now(),
-    note = '\n' + re.sub(r'\r+', '\n', header['note_string']),
-    this_filename = header['this_file_name'],
-    program = '%s v%s' % (header['recording_program_name'],
-                          header['recording_program_version']),
-    coord = 'UTM %d%s, m' % (zone, hemisphere) if to_utm else 'geographic')
-
-    segy.write_SEGY(outfile, segy_header, text_header, traces())
+        filename = infile,
+        version =  version.__version__,
+        url = version.url,
+        user = getuser(),
+        datetime = datetime.now(),
+        note = '\n' + re.sub(r'\r+', '\n', header['note_string']),
+        this_filename = header['this_file_name'],
+        program = '%s v%s' % (header['recording_program_name'],
+                              header['recording_program_version']),
+        channel = p0.channel_number + 1,
+        coord = coordinates.description)
+
+        self.writer = segy.SEGYWriter(outfile, segy_header, text_header, sync)
+
+    def trace_header(self, p, delay = None):
+        # Using sensor_[xy]coordinate seems to be more appropriate here,
+        # but in practice it's not. Chesapeake XTF-To-SEGY converter
+        # is also using ship_[xy]coordinate.
+        x, y = self.coordinates.converter(p.sheader['ship_xcoordinate'],
+                                          p.sheader['ship_ycoordinate'])
+
+        trace_header = dict(
+            trace_seq_in_line = self.n_traces,
+            trace_seq_in_file = self.n_traces,
+
+            # not suitable for trace_seq_in_*, counts 1 3 5 7...
+            trace_num_in_orig_record = p.sheader['ping_number'],
+
+            trace_id_code = 1, # seismic
+
+            year = p.sheader['year'],
+            day_of_year = p.sheader['julian_day'],
+            hour = p.sheader['hour'],
+            minute = p.sheader['minute'],
+            second = p.sheader['second'],
+
+            time_basis_code = 4,
+            n_samples = self.n_samples,
+            sample_interval = self.sample_interval,
+            elevations_scaler = 1,
+
+            coordinate_units = self.coordinates.units,
+            coordinates_scaler = self.coordinates.scaler,
+            reciever_coord_x = int(round(x)),
+            reciever_coord_y = int(round(y)),
+
+            #ensemble_num = ... # For marks when importing to Geographix
+        )
+        if self.stack:
+            trace_header['n_of_horizontally_summed_traces'] = self.decimate
+        if delay is not None:
+            trace_header['delay_recording_time'] = int(round(delay * 1000))
+        return trace_header
+
+    def write(self, p):
+        # make sure we don't have variable trace len or sample interval
+        for name in 'num_samples', 'time_duration':
+            if p.cheader[name] != self.p0.cheader[name]:
+                raise BadDataError('Ping %d: %s == %r, expected %r' %
+                                   (p.sheader['ping_number'], name,
+                                    p.cheader[name], self.p0.cheader[name]))
+
+        self.pending.append(p)
+        while block_ready(self.pending, self.block_pings, self.attitude):
+            self.flush(self.block_pings)
+
+    def flush(self, count = None):
+        """Process and write `count` (all by default) pending packets"""
+        packets = self.pending[:count]
+        self.pending = self.pending[len(packets):]
+        if not packets:
+            return
+
+        if self.process is not None:
+            traces = process_traces(self.process, packets)
+        else:
+            traces = np.vstack([p.trace for p in packets])
+        delays = [None] * len(packets)
+        if self.window is not None:
+            traces, delays = self.window.crop(traces,
+                                        packet_columns(packets, WINDOW_FIELDS))
+        if self.decimate > 1:
+            traces = decimate_pings(traces, self.decimate, self.stack)
+            packets = packets[::self.decimate]
+            delays = delays[::self.decimate]
+        if self.resample > 1:
+            traces = resample_samples(traces, self.resample)
+        traces = segy.encode_samples(traces, self.sample_format)
+
+        for p, trace, delay in zip(packets, traces, delays):
+            self.n_traces += 1
+            self.writer.write_trace(self.trace_header(p, delay), trace)
+
+    def finish(self):
+        """Write all traces, but leave the file under its temporary name"""
+        self.flush()
+        self.writer.finish()
+
+    def close(self):
+        self.finish()
+        self.writer.close()
+
+    def abort(self):
+        self.writer.abort()
+
+def segy_filenames(outfile, channel_numbers):
+    """Output file names of export_SEGY, one file per channel
+
+    >>> segy_filenames('line.seg', [0])
+    ['line.seg']
+    >>> segy_filenames('line.seg', [0, 2])
+    ['line_ch1.seg', 'line_ch3.seg']
+    """
+    if len(channel_numbers) == 1:
+        return [outfile]
+    base, ext = split_ext(outfile)
+    return ['%s_ch%d%s' % (base, ch + 1, ext) for ch in channel_numbers]
+
+def export_SEGY(infile, outfile, channel_numbers, to_utm = True,
+                                                  utm_params = None,
+                                                  sync = False, skipped = None,
+                                                  attitude = None, **options):
+    """Convert channels of XTF file to SEG-Y, reading `infile` only once
+
+    Each channel goes to its own SEG-Y file, see segy_filenames. Files are
+    renamed to their names only after all of them are completely written.
+
+    skipped - list to turn on recovery mode, see index_packets
+    attitude - AttitudeSeries to add attitude packets to while reading, for
+               processing operators using it (e.g. processing.Heave)
+    options - SEGYChannelWriter options (decimate, stack, resample,
+              sample_format, process, window)
+    """
+    header, chaninfos, packets = read_XTF(infile, 'sonar' if attitude is None
+                                                  else '*', skipped)
+    write_SEGY_channels(infile, outfile, header, chaninfos, packets,
+                        channel_numbers, to_utm, utm_params, sync, attitude,
+                        **options)
+
+def write_SEGY_channels(infile, outfile, header, chaninfos, packets,
+                        channel_numbers, to_utm = True, utm_params = None,
+                        sync = False, attitude = None, **options):
+    """Write sonar `packets` of XTF file `infile` to SEG-Y, see export_SEGY"""
+    channel_numbers = sorted(set(channel_numbers))
+    for ch in channel_numbers:
+        if not 0 <= ch < len(chaninfos):
+            raise BadDataError('Channel %d not found in "%s"' %
+                                                (ch + 1, infile))
+    outfiles = dict(zip(channel_numbers,
+                        segy_filenames(outfile, channel_numbers)))
+
+    writers = {}
+    coordinates = None
+    try:
+        for p in packets:
+            if not hasattr(p, 'sheader'): # not a sonar packet
+                if attitude is not None:
+                    attitude.add([p])
+                continue
+            ch = p.channel_number
+            if ch not in outfiles:
+                continue
+            try:
+                writer = writers[ch]
+            except KeyError:
+                # the same coordinates for all channels, even if the first
+                # packet of some channel happens to be in another UTM zone
+                if coordinates is None:
+                    coordinates = segy_coordinates(p, to_utm, utm_params)
+                writer = writers[ch] = SEGYChannelWriter(outfiles[ch], infile,
+                                                         header, chaninfos[ch],
+                                                         p, coordinates, sync,
+                                                         attitude = attitude,
+                                                         **options)
+            writer.write(p)
+
+        for ch in channel_numbers:
+            if ch not in writers:
+                raise BadDataError('Channel %d not found inside "%s"' %
+                                                    (ch + 1, infile))
+        for writer in writers.values():
+            writer.finish()
+        for writer in writers.values():
+            writer.close()
+    except:
+        for writer in writers.values():
+            writer.abort()
+        raise
+
+def export_SEGY_merged(infiles, outfile, channel_number, to_utm = True,
+                                                         utm_params = None,
+                                                         order_by_time = False,
+                                                         sync = False,
+                                                         **options):
+    """Convert one channel of several XTF files to one continuous SEG-Y file
+
+    Files are read one at a time, traces are numbered continuously. All files
+    must have the same sample interval and trace length.
+
+    order_by_time - sort `infiles` by first ping time instead of given order
+    options - SEGYChannelWriter options (decimate, stack, resample,
+              sample_format, process, window)
+    """
+    if order_by_time:
+        infiles = sorted(infiles, key = first_ping_time)
+    if not infiles:
+        raise BadDataError('No files to merge')
+    description = ('%s ... %s (%d files)' % (infiles[0], infiles[-1],
+                                              len(infiles))
+                   if len(infiles) > 1 else infiles[0])
+
+    writer = None
+    try:
+        for infile in infiles:
+            header, chaninfos, packets = read_XTF(infile, 'sonar')
+            if not 0 <= channel_number < len(chaninfos):
+                raise BadDataError('Channel %d not found in "%s"' %
+                                                (channel_number + 1, infile))
+            chaninfo = chaninfos[channel_number]
+            if (writer is not None and
+                    chaninfo['bytes_per_sample'] != writer.bytes_per_sample):
+                raise BadDataError('%s: bytes_per_sample == %d, expected %d' %
+                                   (infile, chaninfo['bytes_per_sample'],
+                                    writer.bytes_per_sample))
+
+            for p in packets:
+                if p.channel_number != channel_number:
+                    continue
+                if writer is None:
+                    coordinates = segy_coordinates(p, to_utm, utm_params)
+                    writer = SEGYChannelWriter(outfile, description, header,
+                                               chaninfo, p, coordinates, sync,
+                                               **options)
+                try:
+                    writer.write(p)
+                except BadDataError, e:
+                    raise BadDataError('%s: %s' % (infile, e))
+
+        if writer is None:
+            raise BadDataError('Channel %d not found inside any of %d files' %
+                                            (channel_number + 1, len(infiles)))
+        writer.close()
+    except:
+        if writer is not None:
+            writer.abort()
+        raise
 
 PLOT_NTRACES = 3000
 
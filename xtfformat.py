@@ -0,0 +1,296 @@
+"""xtfformat.py - XTF file structures and header-only reading
+
+Kept free of numpy and other heavy imports, so that tools looking only at
+headers (see xtfinfo.py) start fast. xtf.py re-exports everything from here.
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+
+from sacker import unwrap, BadDataError
+
+# XTF spec: http://www.tritonimaginginc.com/site/content/public/downloads/FileFormatInfo/Xtf%20File%20Format_X35.pdf
+
+CHAN_TYPES = {
+    0: 'subbottom',
+    1: 'port',
+    2: 'stbd',
+    3: 'bathymetry',
+}
+CHANINFO_LEN = 128
+HEADER_TYPES = {
+    0: 'sonar', # sidescan and subbottom
+    1: 'notes', # notes - text annotation
+    2: 'bathy', # bathymetry (Seabat, Odom)
+    3: 'attitude', # TSS or MRU attitude (pitch, roll, heave, yaw)
+    4: 'forward', # forward-look sonar (polar display)
+    5: 'elac', # Elac multibeam
+    6: 'raw_serial', # Raw data from serial port
+    7: 'embed_head', # Embedded header structure
+    8: 'hidden_sonar', # hidden (non-displayable) ping
+}
+HEADER_LEN = 1024
+
+HEADER = """
+    B file_format == 0x7b !
+    B system_type
+    8s recording_program_name
+    8s recording_program_version
+    16s sonar_name
+    H sonar_type
+    64s note_string
+    64s this_file_name
+    H nav_units
+    H number_of_sonar_channels
+    H number_of_bathymetry_channels
+    B number_of_snippet_channels
+    B number_of_forward_look_arrays
+    H number_of_echo_strength_channels
+    B number_of_interferometry_channels
+    B reserved1
+    H reserved2
+    f reference_point_height
+    12s projection_type
+    10s spheroid_type
+    l navigation_latency
+    f origin_x
+    f origin_y
+    f nav_offset_y
+    f nav_offset_x
+    f nav_offset_z
+    f nav_offset_yaw
+    f MRU_offset_y
+    f MRU_offset_x
+    f MRU_offset_z
+    f MRU_offset_yaw
+    f MRU_offset_pitch
+    f MRU_offset_roll
+"""
+
+CHANINFO = """
+    B type_of_channel
+    B sub_channel_number
+    H correction_flags
+    H uni_polar
+    H bytes_per_sample
+    I reserved1
+    16s channel_name
+    f volt_scale
+    f frequency
+    f horiz_beam_angle
+    f tilt_angle
+    f beam_width
+    f offset_x
+    f offset_y
+    f offset_z
+    f offset_yaw
+    f offset_pitch
+    f offset_roll
+    H beams_per_array
+    54s reserved2
+"""
+
+NOTES_HEADER = """
+    H year
+    B month
+    B day
+    B hour
+    B minute
+    B second
+    35s reserved
+    200s notes_text
+"""
+
+ATTITUDE_HEADER = """
+    8s reserved2
+    I epoch_microseconds
+    I source_epoch
+    f pitch
+    f roll
+    f heave
+    f yaw
+    I time_tag
+    f heading
+    H year
+    B month
+    B day
+    B hour
+    B minute
+    B second
+    H milliseconds
+    1s reserved3
+"""
+
+def read_header(data):
+    """(header, chaninfos) from the start of XTF file `data` (string/buffer)"""
+    if len(data) < HEADER_LEN:
+        raise BadDataError('File is too short for XTF header')
+    header_len, header = unwrap(data, HEADER, data_factory = OrderedDict)
+    nchannels = (header['number_of_sonar_channels'] +
+                 header['number_of_bathymetry_channels'])
+    assert nchannels <= 6
+    chaninfos = []
+    for i in range(nchannels):
+        chaninfo_len, chaninfo = unwrap(data[header_len+i*CHANINFO_LEN:],
+                                        CHANINFO)
+        assert chaninfo_len == CHANINFO_LEN
+        chaninfos.append(chaninfo)
+    return header, chaninfos
+
+def header_type(pheader):
+    return HEADER_TYPES.get(pheader['header_type'],
+                                   'UNKNOWN (%d)' % pheader['header_type'])
+
+PACKET_HEADER = """
+    H magic_number == 0xFACE !
+    B header_type
+    B sub_channel_number
+    H num_chans_to_follow
+    4s reserved1
+    I num_bytes_this_record
+"""
+
+SONAR_HEADER = """
+    H year
+    B month
+    B day
+    B hour
+    B minute
+    B second
+    B hseconds
+    H julian_day
+    I event_number
+    I ping_number
+    f sound_velocity
+    f ocean_tide
+    I reserved2
+    f conductiviy_freq
+    f temperature_freq
+    f pressure_freq
+    f pressure_temp
+    f conductivity
+    f water_temperature
+    f pressure
+    f computed_sound_velocity
+    f mag_x
+    f mag_y
+    f mag_z
+    f aux_val1
+    f aux_val2
+    f aux_val3
+    f aux_val4
+    f aux_val5
+    f aux_val6
+    f speed_log
+    f turbidity
+    f ship_speed
+    f ship_gyro
+    d ship_ycoordinate
+    d ship_xcoordinate
+    H ship_alititude
+    H ship_depth
+    B fix_time_hour
+    B fix_time_minute
+    B fix_time_second
+    B fix_time_hsecond
+    f sensor_speed
+    f KP
+    d sensor_ycoordinate
+    d sensor_xcoordinate
+    H sonar_status
+    H range_to_fish
+    H bearing_to_fish
+    H cable_out
+    f layback
+    f cable_tension
+    f sensor_depth
+    f sensor_primary_altitude
+    f sensor_aux_altitude
+    f sensor_pitch
+    f sensor_roll
+    f sensor_heading
+    f heave
+    f yaw
+    I attitude_time_lag
+    f DOT
+    I nav_fix_milliseconds
+    B computer_clock_hour
+    B computer_clock_minute
+    B computer_clock_second
+    B computer_clock_hsec
+    h fish_position_delta_x
+    h fish_position_delta_y
+    B fish_position_error_code
+    11s reserved3
+"""
+
+SONAR_CHANNEL_HEADER = """
+    H channel_number
+    H downsample_method
+    f slant_range
+    f ground_range
+    f time_delay
+    f time_duration
+    f seconds_per_ping
+    H processing_flags
+    H frequency
+    H initial_gain_code
+    H gain_code
+    H band_width
+    I contact_number
+    H contact_classification
+    B contact_sub_number
+    b contact_type
+    I num_samples
+    H millivolt_scale
+    f contact_time_of_track
+    B contact_close_number
+    B reserved2
+    f fixed_VSOP
+    h weight
+    4s reserved
+"""
+
+PACKET_HEADER_LEN = 14
+
+def _packet_headers(f, offset):
+    """(offset, pheader, header data) of packets, see scan_packets"""
+    position = f.tell()
+    while True:
+        if position != offset:
+            f.seek(offset) # forward, over the rest of the packet
+        data = f.read(PACKET_HEADER_LEN)
+        if len(data) < PACKET_HEADER_LEN:
+            return
+        pheader_len, pheader = unwrap(data, PACKET_HEADER)
+        if pheader['num_bytes_this_record'] < PACKET_HEADER_LEN:
+            raise BadDataError('Bad num_bytes_this_record == %d at %d' %
+                               (pheader['num_bytes_this_record'], offset))
+        yield offset, pheader, data
+        position = f.tell()
+        offset += pheader['num_bytes_this_record']
+
+def scan_packets(f, offset = HEADER_LEN):
+    """Iterate over (offset, pheader) of packets in XTF file object `f`
+
+    Only packet headers are read. After each step `f` is positioned right
+    after the packet header, so caller may read a part of the rest of the
+    packet. `f` is never seeked back, so .gz and .xz files are read once.
+    """
+    for offset, pheader, data in _packet_headers(f, offset):
+        yield offset, pheader
+
+def read_packets_forward(f, offset = HEADER_LEN):
+    """Iterate over (offset, pheader, packet data) of XTF file object `f`
+
+    Like scan_packets, but whole packets are read, without seeking back.
+    Data of truncated last packet is shorter than num_bytes_this_record.
+    """
+    for offset, pheader, data in _packet_headers(f, offset):
+        yield offset, pheader, data + f.read(pheader['num_bytes_this_record'] -
+                                             PACKET_HEADER_LEN)
+
+def ping_datetime(sheader):
+    return datetime(sheader['year'], sheader['month'], sheader['day'],
+                    sheader['hour'], sheader['minute'], sheader['second'],
+                    sheader['hseconds'] * 10000)
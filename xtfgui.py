@@ -6,6 +6,7 @@ import webbrowser
 import re
 import sys
 from functools import partial
+from multiprocessing import freeze_support
 
 import numpy
 from GUI import Application, ScrollableView, Document, Window, Globals, rgb
@@ -24,6 +25,8 @@ from GUI.BaseAlertFunctions import present_and_destroy
 from GUI.Alerts import confirm, stop_alert
 
 import xtf
+import spatial
+import overview
 
 def log(*args):
     sys.stdout.write(' '.join(args) + '\n')
@@ -37,6 +40,7 @@ def app_menu(profiles = None):
             'save_cmd': 'Save Project',
             'save_as_cmd': 'Save Project As...'})
     menus.append(Menu('Profile', [('Import XTF files...', 'import_cmd'),
+                                  ('Survey overview', 'overview_cmd'),
                                   '-',
                                   (profiles or [], 'profiles_cmd')]))
     menus.append(Menu('Tools', [('Export trace headers to CSV (Excel)...',
@@ -166,6 +170,7 @@ class ProjectWindow(Window):
         m.preferences_cmd.enabled = True
         if self.current_file is not None:
             m.export_csv_cmd.enabled = True
+        m.overview_cmd.enabled = bool(self.document.files)
         m.profiles_cmd.enabled = True
         m.profiles_cmd.checked = False
         if self.current_file is not None:
@@ -177,6 +182,10 @@ class ProjectWindow(Window):
             self.document.add_files([os.path.join(r.dir.path, r.name)
                                      for r in refs])
 
+    def overview_cmd(self):
+        cache = self.document.update_overview()
+        OverviewWindow(self.document, cache).show()
+
     def profiles_cmd(self, i):
         self.current_file = i
         self.project_changed(self.document)
@@ -211,13 +220,17 @@ class ProjectWindow(Window):
         ref = request_old_directory('Save SEG-Y files to folder',
                                     self.segy_dir or default_dir)
         export = partial(xtf.export_SEGY, utm_params = application().utm_params)
-        if self.batch_export(ref, export, '.seg'):
+        if self.batch_export(ref, export, '.seg', xtf.segy_filenames):
             self.segy_dir = ref # remember selected dir for next time
 
-    def batch_export(self, out_dir, export_function, ext):
-        """Run export_function on all project files. Return True on success"""
+    def batch_export(self, out_dir, export_function, ext,
+                           out_filenames = lambda f, numbers: [f]):
+        """Run export_function on all project files. Return True on success
+
+        out_filenames(filename, channel_numbers) - actual output file names
+        """
 
-        ext_re = re.compile(r'\.xtf$', re.I)
+        ext_re = re.compile(r'\.xtf(\.gz|\.xz|\.zblk)?$', re.I)
 
         if out_dir is not None:
             numbers = [i for i, cb in enumerate(self.checkboxes) if cb.value]
@@ -226,13 +239,19 @@ class ProjectWindow(Window):
             dst = [ext_re.sub('', os.path.split(p)[1]) + ext for p in src]
             dstf = [os.path.join(out_dir.path, d) for d in dst]
 
-            existing = [d for d, df in zip(dst, dstf) if os.path.exists(df)]
+            existing = [os.path.split(f)[1] for df in dstf
+                        for f in out_filenames(df, numbers)
+                        if os.path.exists(f)]
             if (not existing or confirm('%s already has files: %s. Overwrite?'
                                      % (out_dir.path, ', '.join(existing)))):
                 for i, (s, d, df) in enumerate(zip(src, dst, dstf)):
                     log('[%d/%d] %s -> %s' % (i+1, len(dst), s, d))
+                    skipped = []
                     try:
-                        export_function(s, df, numbers)
+                        export_function(s, df, numbers, skipped = skipped)
+                        if skipped:
+                            log('Damaged data skipped in %s, bytes: %s' % (s,
+                                ', '.join('%d-%d' % r for r in skipped)))
                     except xtf.BadDataError, e:
                         msg = 'Aborted! %s.' % (e,)
                         log(msg)
@@ -314,12 +333,12 @@ class ProjectWindow(Window):
     def setup_buttons(self):
         self.xtf_btn.enabled = self.xtf_all_btn.enabled = \
                 any(cb.value for cb in self.checkboxes)
-        self.segy_btn.enabled = self.segy_all_btn.enabled = \
-                len([cb.value for cb in self.checkboxes if cb.value]) == 1
-        if self.segy_btn.enabled:
-            self.label.text = ''
+        n_checked = len([cb.value for cb in self.checkboxes if cb.value])
+        self.segy_btn.enabled = self.segy_all_btn.enabled = n_checked > 0
+        if n_checked > 1:
+            self.label.text = '(SEG-Y: one file per channel)'
         else:
-            self.label.text = '(select exactly one channel to enable SEG-Y)'
+            self.label.text = ''
 
     def update_title(self):
         doc = self.document
@@ -432,6 +451,21 @@ class FileView(Frame):
             content.bounds = 0, H / n * i, W, H / n * (i + 1)
 
 
+class OverviewWindow(Window):
+    """Thumbnails of all project lines side by side, one row per channel"""
+
+    def __init__(self, document, cache):
+        Window.__init__(self, size = (800, 400),
+                        title = 'Overview - %s' % document.title)
+        self.channels = []
+        for number in cache.channels():
+            strip, spans = cache.strip(document.files, number)
+            image = image_from_rgb_array(rgb_array(strip))
+            self.channels.append(Channel(image, number))
+        self.place(FileView(self), top = 0, bottom = 0, left = 0, right = 0,
+                                   sticky = 'nesw')
+
+
 class Channel(Model):
     def __init__(self, image, number):
         Model.__init__(self)
@@ -462,6 +496,8 @@ class ChannelView(ScrollableView):
 class Project(Document):
     magic = 'XTF PROJECT'
     files = None
+    spatial_index = None
+    overview = None
 
     def abspaths(self):
         return [f if os.path.isabs(f) else os.path.join(self.file.dir.path, f)
@@ -482,6 +518,7 @@ class Project(Document):
         for f in self.files:
             file.write(f + '\n')
         self.notify_windows('project_changed')
+        self.update_spatial_index()
 
     def normpath(self, p):
         if self.file:
@@ -498,6 +535,61 @@ class Project(Document):
                 self.changed()
         self.files.sort()
         self.notify_windows('project_changed', self.normpath(filenames[0]))
+        self.update_spatial_index()
+
+    def update_spatial_index(self):
+        """Index new or changed files, save index next to project file"""
+        if not self.file:
+            return # new project, nowhere to save index yet
+        proj_dir = self.file.dir.path
+        path = spatial.index_path(os.path.join(proj_dir, self.file.name))
+        if self.spatial_index is None or self.spatial_index.path != path:
+            self.spatial_index = spatial.SpatialIndex.load(path)
+        index = self.spatial_index
+
+        removed = set(index.lines) - set(self.files)
+        for f in removed:
+            index.remove(f)
+        try:
+            updated = index.update(self.files, proj_dir)
+        except EnvironmentError, e:
+            log('Spatial index not updated: %s' % (e,))
+        else:
+            for f, error in sorted(index.errors.items()):
+                log('Spatial index: %s skipped (%s)' % (f, error))
+            for f, skipped in sorted(index.damaged.items()):
+                log('Spatial index: %s damaged, bytes skipped: %s' % (f,
+                    ', '.join('%d-%d' % r for r in skipped)))
+            if removed or updated:
+                index.save()
+
+    def update_overview(self):
+        """Thumbnails of new or changed files, saved next to project file"""
+        if self.file:
+            proj_dir = self.file.dir.path
+            path = overview.cache_path(os.path.join(proj_dir, self.file.name))
+        else:
+            proj_dir, path = '', None # new project, keep cache in memory
+        if self.overview is None or self.overview.path != path:
+            if path is None:
+                self.overview = overview.OverviewCache()
+            else:
+                self.overview = overview.OverviewCache.load(path)
+        cache = self.overview
+
+        removed = set(cache.lines) - set(self.files)
+        for f in removed:
+            cache.remove(f)
+        try:
+            updated = cache.update(self.files, proj_dir)
+        except EnvironmentError, e:
+            log('Overview not updated: %s' % (e,))
+        else:
+            for f, error in sorted(cache.errors.items()):
+                log('Overview: %s skipped (%s)' % (f, error))
+            if path is not None and (removed or updated):
+                cache.save()
+        return cache
 
     def notify_windows(self, *event):
         for window in self.windows:
@@ -528,4 +620,6 @@ class AboutBox(BaseAlert):
         webbrowser.open(self.url)
         self.yes()
 
-XTFApp(title = 'XTF Surveyor').run()
+if __name__ == '__main__':
+    freeze_support() # overview thumbnails are made in a process pool
+    XTFApp(title = 'XTF Surveyor').run()
@@ -0,0 +1,135 @@
+"""xtfinfo.py - print summary of XTF files: header, channels, packets, pings
+
+From command line:
+    python xtfinfo.py <xtf-file-or-directory> ...
+
+Directories are searched recursively. Only packet headers are read and numpy
+isn't imported, so it's cheap to run over whole archives in one go.
+"""
+
+import os
+import sys
+import struct
+from collections import Counter
+from datetime import datetime
+
+from sacker import BadDataError
+from fileio import map_input, split_ext
+from xtfformat import (CHAN_TYPES, HEADER_TYPES, HEADER_LEN, PACKET_HEADER_LEN,
+                       read_header)
+
+XTF_EXTENSIONS = ('.xtf', '.xtf.gz', '.xtf.xz', '.xtf.zblk')
+
+PACKET_START = struct.Struct('<HBBH4xI') # PACKET_HEADER
+PING_START = struct.Struct('<HBBBBBB6xI') # SONAR_HEADER up to ping_number
+CHANNEL_NUMBER = struct.Struct('<H') # SONAR_CHANNEL_HEADER
+CHANNEL_HEADER_OFFSET = 256
+
+def ping_time(t):
+    """datetime from PING_START time fields"""
+    try:
+        return datetime(*t[:6] + (t[6] * 10000,))
+    except ValueError, e:
+        raise BadDataError('Bad ping time %r: %s' % (t, e))
+
+class FileInfo(object):
+    """Summary of XTF file, collected from packet headers only"""
+
+    def __init__(self, path):
+        self.path = path
+        data = map_input(path)
+        try:
+            self.header, self.chaninfos = read_header(data)
+            self._scan(data)
+        finally:
+            if hasattr(data, 'close'):
+                data.close()
+
+    def _scan(self, data):
+        self.packet_counts = Counter()
+        self.channel_counts = Counter()
+        self.first_ping = self.last_ping = None
+        self.first_time = self.last_time = None
+        self.truncated = None
+
+        size = len(data)
+        offset = HEADER_LEN
+        while offset + PACKET_HEADER_LEN <= size:
+            magic, type, sub, nchans, n = PACKET_START.unpack_from(data,
+                                                                   offset)
+            if magic != 0xFACE or n < PACKET_HEADER_LEN:
+                raise BadDataError('Bad packet header at %d' % offset)
+            if offset + n > size:
+                break
+            self.packet_counts[type] += 1
+            if type == 0 and n >= CHANNEL_HEADER_OFFSET + CHANNEL_NUMBER.size:
+                ping = PING_START.unpack_from(data, offset + PACKET_HEADER_LEN)
+                time, number = ping[:-1], ping[-1]
+                if self.first_ping is None:
+                    self.first_ping = self.last_ping = number
+                    self.first_time = self.last_time = time
+                self.first_ping = min(self.first_ping, number)
+                self.last_ping = max(self.last_ping, number)
+                self.first_time = min(self.first_time, time)
+                self.last_time = max(self.last_time, time)
+                self.channel_counts[CHANNEL_NUMBER.unpack_from(
+                        data, offset + CHANNEL_HEADER_OFFSET)[0]] += 1
+            offset += n
+        if offset < size:
+            self.truncated = offset
+
+    def lines(self):
+        h = self.header
+        yield '%s' % self.path
+        yield '  %s %s, sonar %r (type %d)' % (
+                        h['recording_program_name'].rstrip('\0'),
+                        h['recording_program_version'].rstrip('\0'),
+                        h['sonar_name'].rstrip('\0'), h['sonar_type'])
+        note = h['note_string'].rstrip('\0')
+        if note:
+            yield '  note: %s' % note
+        for i, c in enumerate(self.chaninfos):
+            yield '  channel %d: %s %r, %d bytes/sample, %g Hz, %d pings' % (
+                        i, CHAN_TYPES.get(c['type_of_channel'], 'unknown'),
+                        c['channel_name'].rstrip('\0'), c['bytes_per_sample'],
+                        c['frequency'], self.channel_counts[i])
+        yield '  packets: ' + ', '.join(
+                        '%s %d' % (HEADER_TYPES.get(t, 'type %d' % t), n)
+                        for t, n in sorted(self.packet_counts.items()))
+        if self.first_ping is not None:
+            start, end = ping_time(self.first_time), ping_time(self.last_time)
+            yield '  pings: %d .. %d' % (self.first_ping, self.last_ping)
+            yield '  time: %s .. %s (%s)' % (start, end, end - start)
+        if self.truncated is not None:
+            yield '  truncated packet at %d' % self.truncated
+
+def find_files(paths):
+    """XTF files in `paths`, directories are searched recursively"""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if split_ext(name)[1].lower() in XTF_EXTENSIONS:
+                    yield os.path.join(dirpath, name)
+
+def main(paths):
+    errors = 0
+    for path in find_files(paths):
+        try:
+            lines = list(FileInfo(path).lines())
+        except (BadDataError, EnvironmentError), e:
+            print '%s\n  error: %s' % (path, e)
+            errors += 1
+            continue
+        for line in lines:
+            print line
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit('Error: wrong arguments\n' + __doc__.rstrip())
+
+    sys.exit(main(sys.argv[1:]))
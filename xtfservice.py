@@ -0,0 +1,237 @@
+"""xtfservice.py - local service decoding XTF files once for many processes
+
+Server decodes each XTF file with read_XTF_as_grayscale_arrays only once and
+keeps channel arrays and trace header columns as .npy files in a cache
+directory. Clients get file names and open them with numpy memmap, so all
+processes share the same pages of memory.
+
+Files of an opened XTF file are kept while any client holds a reference to
+it. Released files stay in cache until the total size exceeds the memory
+budget, then the least recently used ones are removed.
+
+From command line (authentication key is taken from XTFSERVICE_KEY):
+    python xtfservice.py [<host>:<port> | <unix-socket-path>]
+
+Usage:
+    with XTFServiceClient(ADDRESS, authkey) as client:
+        header, nchannels, arrays = client.grayscale_arrays(infile)
+        ...
+        client.release(infile)
+"""
+
+import os
+import sys
+import shutil
+import threading
+from collections import OrderedDict
+from tempfile import mkdtemp
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+
+import xtf
+
+ADDRESS = ('localhost', 17900)
+MEMORY_BUDGET = 2 * 2**30 # bytes of cached arrays
+
+class CacheEntry(object):
+    def __init__(self, key):
+        self.key = key # (path, mtime, size)
+        self.lock = threading.Lock() # held while decoding
+        self.info = None # reply to 'open' request
+        self.files = []
+        self.size = 0
+        self.refcount = 0
+
+class XTFService(object):
+    """Decode XTF files on request, see module docstring"""
+
+    def __init__(self, address = ADDRESS, authkey = None,
+                       memory_budget = MEMORY_BUDGET, cache_dir = None):
+        if not authkey:
+            raise ValueError('authkey is required')
+        self.listener = Listener(address, authkey = authkey)
+        self.address = self.listener.address
+        self.memory_budget = memory_budget
+        self.cache_dir = cache_dir or mkdtemp(prefix = 'xtfservice.')
+        self.entries = OrderedDict() # least recently used first
+        self.lock = threading.Lock()
+        self._n = 0
+
+    def serve_forever(self):
+        try:
+            while True:
+                conn = self.listener.accept()
+                thread = threading.Thread(target = self._serve, args = (conn,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.close()
+
+    def close(self):
+        self.listener.close()
+        shutil.rmtree(self.cache_dir, ignore_errors = True)
+
+    def _serve(self, conn):
+        held = [] # entries referenced by this client
+        try:
+            while True:
+                try:
+                    request, path = conn.recv()
+                except EOFError:
+                    break
+                try:
+                    if request == 'open':
+                        entry = self.acquire(path)
+                        held.append(entry)
+                        conn.send(('ok', entry.info))
+                    elif request == 'release':
+                        # by path: the file may have changed since opening
+                        path = os.path.abspath(path)
+                        opened = [e for e in held if e.key[0] == path]
+                        if opened:
+                            held.remove(opened[0])
+                            self.release(opened[0])
+                            conn.send(('ok', None))
+                        else:
+                            conn.send(('error', 'not opened: %s' % path))
+                    else:
+                        conn.send(('error', 'Unknown request %r' % request))
+                except (xtf.BadDataError, EnvironmentError), e:
+                    conn.send(('error', str(e) or repr(e)))
+        finally:
+            for entry in held: # client has gone, drop its references
+                self.release(entry)
+            conn.close()
+
+    def _key(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        return path, st.st_mtime, st.st_size
+
+    def acquire(self, path):
+        """Decoded CacheEntry of XTF file, with reference count increased"""
+        key = self._key(path)
+        with self.lock:
+            entry = self.entries.pop(key, None) or CacheEntry(key)
+            self.entries[key] = entry # most recently used
+            entry.refcount += 1
+        try:
+            with entry.lock:
+                if entry.info is None:
+                    self._decode(entry)
+        except:
+            self.release(entry)
+            with self.lock:
+                if entry.info is None and entry.refcount == 0:
+                    self.entries.pop(key, None)
+            raise
+        self._evict()
+        return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry.refcount -= 1
+        self._evict()
+
+    def _decode(self, entry):
+        with self.lock:
+            self._n += 1
+            prefix = os.path.join(self.cache_dir, '%d' % self._n)
+        header, nchannels, arrays = xtf.read_XTF_as_grayscale_arrays(
+                                                                entry.key[0])
+        channels = []
+        for num, type, headers, data in arrays:
+            data_file = '%s_ch%d.npy' % (prefix, num)
+            headers_file = '%s_ch%d_headers.npy' % (prefix, num)
+            np.save(data_file, data)
+            np.save(headers_file, np.rec.fromrecords(
+                                    headers, names = xtf.TraceHeader._fields))
+            entry.files += [data_file, headers_file]
+            channels.append((num, type, headers_file, data_file))
+        entry.size = sum(os.path.getsize(f) for f in entry.files)
+        entry.info = header, nchannels, channels
+
+    def _evict(self):
+        """Remove least recently used unreferenced files over the budget"""
+        with self.lock:
+            total = sum(e.size for e in self.entries.values())
+            for key, entry in self.entries.items():
+                if total <= self.memory_budget:
+                    break
+                if entry.refcount == 0 and entry.info is not None:
+                    del self.entries[key]
+                    total -= entry.size
+                    for f in entry.files:
+                        try:
+                            os.remove(f) # mapped data stays for old users
+                        except OSError:
+                            pass
+
+class XTFServiceClient(object):
+    """Connection to XTFService"""
+
+    def __init__(self, address = ADDRESS, authkey = None):
+        self.conn = Client(address, authkey = authkey)
+
+    def _call(self, request, path):
+        self.conn.send((request, path))
+        status, reply = self.conn.recv()
+        if status != 'ok':
+            raise xtf.BadDataError(reply)
+        return reply
+
+    def open(self, infile):
+        """(header, nchannels, channels) of XTF file, see grayscale_arrays
+
+        channels - list of (number, type, header_columns, data):
+            header_columns - structured array with TraceHeader fields
+            data - grayscale array
+            Both are memory-mapped read-only.
+        """
+        header, nchannels, channels = self._call('open', infile)
+        return header, nchannels, [(num, type,
+                                    np.load(headers_file, mmap_mode = 'r'),
+                                    np.load(data_file, mmap_mode = 'r'))
+                                   for num, type, headers_file, data_file
+                                   in channels]
+
+    def grayscale_arrays(self, infile):
+        """Like xtf.read_XTF_as_grayscale_arrays, but decoded by the service"""
+        header, nchannels, channels = self.open(infile)
+        return header, nchannels, [(num, type,
+                                    [xtf.TraceHeader(*row)
+                                     for row in columns.tolist()], data)
+                                   for num, type, columns, data in channels]
+
+    def release(self, infile):
+        """Tell service that arrays of `infile` aren't used any more"""
+        self._call('release', infile)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+def parse_address(s):
+    if ':' in s and not os.path.exists(s):
+        host, port = s.rsplit(':', 1)
+        return host, int(port)
+    return s
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 or not os.environ.get('XTFSERVICE_KEY'):
+        sys.exit('Error: wrong arguments or no XTFSERVICE_KEY\n' +
+                 __doc__.rstrip())
+
+    address = parse_address(sys.argv[1]) if len(sys.argv) > 1 else ADDRESS
+    service = XTFService(address, os.environ['XTFSERVICE_KEY'])
+    print 'Serving at %s, cache in %s' % (service.address, service.cache_dir)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass